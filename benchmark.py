@@ -0,0 +1,377 @@
+"""Synthetic ETFG data generator and end-to-end benchmark of the file_handler2 stages.
+
+Usage:
+    python benchmark.py --n-etfs 100 --n-securities 5000 --n-holdings 200 --n-jobs 4
+
+The synthetic ETFG tree and the stage outputs are written under --workdir. Each stage runs in a fresh process so that
+its peak RSS is measured separately. Results are appended to --results and compared with the last run of the same
+parameters.
+
+Requires openpyxl, with which the header workbooks of the synthetic tree are written (pip install openpyxl).
+"""
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from pyanomaly.globals import *
+
+stages = ['profile', 'fundflow', 'securities', 'holdings', 'link', 'index', 'equity']
+
+# stage: input dataset whose rows define the rows/sec of the stage.
+stage_inputs = {
+    'profile': 'industry',
+    'fundflow': 'fundflow',
+    'securities': 'constituents',
+    'holdings': 'constituents',
+    'link': 'constituents',
+    'index': 'constituents',
+    'equity': 'constituents',
+}
+
+# Columns of the generated files after renaming. The header files list the raw names, see get_header().
+generated_columns = {
+    'industry': [
+        'date', 'ticker', 'issuer', 'description', 'inception_date', 'primary_benchmark', 'tax_classification',
+        'is_etn', 'asset_class', 'category', 'focus', 'development_class', 'region', 'is_levered', 'levered_amount',
+        'is_active', 'administrator', 'advisor', 'custodian', 'distributor', 'portfolio_manager', 'subadvisor',
+        'transfer_agent', 'trustee', 'futures_commission_merchant', 'fiscal_year_end', 'distribution_frequency',
+        'listing_exchange', 'creation_unit_size', 'creation_fee', 'lead_market_maker', 'aum',
+        'avg_daily_trading_volume', 'num_holdings',
+    ],
+    'fundflow': ['date', 'ticker', 'shrout', 'nav', 'fundflow'],
+    'constituents': [
+        'date', 'composite_ticker', 'ticker', 'name', 'weight', 'market_value', 'cusip', 'isin', 'figi', 'sedol',
+        'country', 'exchange', 'shares_held', 'asset_class', 'security_type', 'currency',
+    ],
+}
+
+words = [
+    'american', 'global', 'united', 'first', 'national', 'pacific', 'energy', 'capital', 'health', 'systems',
+    'technologies', 'financial', 'resources', 'industries', 'holdings', 'group', 'partners', 'bancorp', 'pharma',
+    'realty', 'international', 'brands', 'networks', 'materials', 'services', 'foods', 'motors', 'semiconductor',
+]
+letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+alnum = np.array(list('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+
+def _random_strings(rng, n, length, chars=alnum):
+    return pd.Series([''.join(row) for row in rng.choice(chars, (n, length))], dtype=object)
+
+
+def _unique_tickers(rng, n, exclude=()):
+    tickers = []
+    seen = set(exclude)
+    while len(tickers) < n:
+        ticker = ''.join(rng.choice(letters, rng.integers(2, 5)))
+        if ticker not in seen:
+            seen.add(ticker)
+            tickers.append(ticker)
+    return tickers
+
+
+def get_header(dataset, format):
+    """Raw column names of a generated file: the inverse of the header map of the format.
+    """
+    import file_handler2 as fh
+
+    inverse = {col: raw for raw, col in fh.schemas[dataset][format][1].items()}
+    return [inverse.get(col, col) for col in _get_columns(dataset, format)]
+
+
+def _get_columns(dataset, format):
+    if format == 'legacy':
+        return [col for col in generated_columns[dataset] if col != 'currency']  # added in v2
+    return generated_columns[dataset]
+
+
+def _make_universe(rng, n_etfs, n_securities):
+    etfs = pd.DataFrame({'ticker': _unique_tickers(rng, n_etfs)})
+    etfs['asset_class'] = rng.choice(['Equity', 'Fixed Income', 'Commodity'], n_etfs, p=[0.8, 0.15, 0.05])
+    etfs['is_etn'] = rng.random(n_etfs) < 0.03
+    etfs['shrout'] = np.round(rng.lognormal(16, 1.5, n_etfs), -3)
+    etfs['nav'] = rng.uniform(20, 300, n_etfs)
+
+    securities = pd.DataFrame({'ticker': _unique_tickers(rng, n_securities, etfs['ticker'])})
+    class_share = rng.random(n_securities) < 0.02
+    securities.loc[class_share, 'ticker'] += '.B'
+    securities['name'] = [' '.join(rng.choice(words, 2)) + ' inc' for _ in range(n_securities)]
+    securities['cusip'] = _random_strings(rng, n_securities, 9)
+    securities['isin'] = 'US' + securities['cusip'] + '0'
+    securities['figi'] = 'BBG' + _random_strings(rng, n_securities, 9)
+    securities['sedol'] = _random_strings(rng, n_securities, 7)
+    foreign = rng.choice(['CA', 'GB', 'JP'], n_securities)
+    securities['country'] = np.where(rng.random(n_securities) < 0.9, 'US', foreign)
+    securities['exchange'] = rng.choice(['NYSE', 'NASDAQ', 'NYSE ARCA'], n_securities)
+    securities['asset_class'] = 'Equity'
+    securities['security_type'] = 'Common Stock'
+    securities['currency'] = 'USD'
+    securities['price'] = rng.lognormal(3.5, 1, n_securities)
+    securities.loc[rng.random(n_securities) < 0.03, 'cusip'] = None  # cusips missing in the files
+    return etfs, securities
+
+
+def generate_stocknames(securities, rng):
+    """Fake CRSP stocknames of the generated securities. Some cusips are changed so that the ticker and name passes
+    of link_permno() are exercised.
+    """
+    n = len(securities)
+    stocknames = pd.DataFrame({
+        'permno': 10000 + np.arange(n),
+        'cusip': securities['cusip'].str[:8].to_numpy(),
+        'ncusip': securities['cusip'].str[:8].to_numpy(),
+        'ticker': securities['ticker'].str.replace('.', '', regex=False).to_numpy(),
+        'comnam': securities['name'].str.upper().to_numpy(),
+        'namedt': pd.Timestamp('2000-01-01'),
+        'nameenddt': pd.Timestamp('2099-12-31'),
+    })
+    changed = rng.random(n) < 0.1
+    stocknames.loc[changed, 'cusip'] = _random_strings(rng, changed.sum(), 8).to_numpy()
+    stocknames.loc[changed, 'ncusip'] = stocknames.loc[changed, 'cusip']
+    stocknames.loc[rng.random(n) < 0.1, 'ticker'] = None
+    return stocknames
+
+
+def _write_file(dataset, date, df):
+    import file_handler2 as fh
+
+    format = fh.get_file_format(date)
+    df = df.copy()
+    for col in ['is_etn', 'is_levered', 'is_active']:
+        if col in df:
+            df[col] = np.where(df[col], 't', 'f') if format == 'legacy' else df[col].astype(int)
+
+    path = fh.get_file_path(dataset, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df[_get_columns(dataset, format)].to_csv(path, header=False, index=False)
+
+
+def generate_etfg_data(root, sdate='2017-03-01', edate='2017-05-31', n_etfs=100, n_securities=5000, n_holdings=200,
+                       seed=0):
+    """Generate a synthetic ETFG tree under `root`.
+
+    Daily industry, fundflow, and constituents files are written in the legacy layout before V2_START_DATE and in the
+    v2 layout from it, together with the header workbooks of both layouts. Each ETF holds about `n_holdings`
+    securities. Prices follow random walks, shares change with fund flows, and a few holdings are replaced every day.
+    A fake CRSP stocknames table of the securities is saved with save_crsp_table().
+
+    Returns:
+        Dict of {dataset: number of rows written}.
+    """
+    import file_handler2 as fh
+
+    fh.set_etfg_dir(root)
+    rng = np.random.default_rng(seed)
+    for format, dir in [('legacy', fh.DIR_LEGACY_HEADER), ('v2', fh.DIR_V2_HEADER)]:
+        os.makedirs(dir, exist_ok=True)
+        for dataset in generated_columns:
+            pd.DataFrame(columns=get_header(dataset, format)).to_excel(dir + fh.schemas[dataset][format][0],
+                                                                      index=False)
+
+    etfs, securities = _make_universe(rng, n_etfs, n_securities)
+    fh.save_crsp_table('stocknames', generate_stocknames(securities, rng), source='synthetic')
+
+    # holdings: (etf, security, shares)
+    sizes = np.clip(rng.poisson(n_holdings, n_etfs), 1, n_securities)
+    holdings = pd.DataFrame({
+        'etf': np.repeat(np.arange(n_etfs), sizes),
+        'security': np.concatenate([rng.choice(n_securities, size, replace=False) for size in sizes]),
+    })
+    holdings['shares'] = np.round(rng.lognormal(10, 1.5, len(holdings)))
+
+    counts = {dataset: 0 for dataset in generated_columns}
+    price = securities['price'].to_numpy()
+    for date in pd.bdate_range(sdate, edate).strftime('%Y-%m-%d'):
+        price = price * np.exp(rng.normal(0, 0.02, n_securities))
+        flow = rng.normal(0, 0.01, n_etfs)
+        etfs['shrout'] = np.round(etfs['shrout'] * (1 + flow), -2)
+        holdings['shares'] = np.round(holdings['shares'] * (1 + flow[holdings['etf']]))
+
+        replaced = rng.random(len(holdings)) < 0.002
+        holdings.loc[replaced, 'security'] = rng.choice(n_securities, replaced.sum())
+        holdings = holdings.drop_duplicates(['etf', 'security'])
+
+        constituents = securities.iloc[holdings['security']].reset_index(drop=True)
+        constituents['composite_ticker'] = etfs['ticker'].to_numpy()[holdings['etf']]
+        constituents['shares_held'] = holdings['shares'].to_numpy()
+        constituents['market_value'] = constituents['shares_held'] * price[holdings['security']]
+        constituents['weight'] = constituents['market_value'] / constituents.groupby('composite_ticker')[
+            'market_value'].transform('sum')
+        constituents['date'] = date
+        _write_file('constituents', date, constituents)
+
+        aum = constituents.groupby('composite_ticker')['market_value'].sum()
+        fundflow = etfs[['ticker', 'shrout']].copy()
+        fundflow['nav'] = aum.reindex(fundflow['ticker']).to_numpy() / fundflow['shrout']
+        fundflow['fundflow'] = flow * fundflow['nav'] * fundflow['shrout']
+        fundflow['date'] = date
+        _write_file('fundflow', date, fundflow)
+
+        industry = pd.DataFrame({col: 'x' for col in generated_columns['industry']}, index=etfs.index)
+        industry['ticker'] = etfs['ticker']
+        industry['asset_class'] = etfs['asset_class']
+        industry['is_etn'] = etfs['is_etn']
+        industry['is_levered'] = False
+        industry['is_active'] = True
+        industry['inception_date'] = '2010-01-04'
+        industry['levered_amount'] = 1.0
+        industry['creation_unit_size'] = 50000
+        industry['creation_fee'] = 500.0
+        industry['aum'] = aum.reindex(etfs['ticker']).to_numpy()
+        industry['avg_daily_trading_volume'] = etfs['shrout'] * 0.01
+        industry['num_holdings'] = constituents.groupby('composite_ticker').size().reindex(etfs['ticker']).to_numpy()
+        industry['date'] = date
+        _write_file('industry', date, industry)
+
+        counts['constituents'] += len(constituents)
+        counts['fundflow'] += len(fundflow)
+        counts['industry'] += len(industry)
+
+    return counts
+
+
+def get_peak_rss_mb():
+    """Peak RSS in MB of this process and of its terminated children (worker pools). None if not available.
+    """
+    import file_handler2 as fh
+    return fh.get_peak_rss_mb(), fh.get_peak_rss_mb(children=True)
+
+
+def run_stage(stage, n_jobs=1):
+    """Run a stage in this process and return its elapsed time and peak RSS.
+    """
+    import file_handler2 as fh
+
+    functions = {
+        'profile': lambda: fh.process_profile_files(n_jobs=n_jobs),
+        'fundflow': lambda: fh.process_fundflow_files(n_jobs=n_jobs),
+        'securities': lambda: fh.process_constituent_files1(),
+        'holdings': lambda: fh.process_constituent_files2(n_jobs=n_jobs),
+        'link': lambda: fh.link_etfg_permno(),
+        'index': lambda: fh.update_holdings_index(),
+        'equity': lambda: fh.generate_equity_etf_data(),
+    }
+    os.makedirs(fh.EQUITY_DATA_DIR, exist_ok=True)
+    start = time.perf_counter()
+    functions[stage]()
+    seconds = time.perf_counter() - start
+    peak_rss_mb, peak_child_rss_mb = get_peak_rss_mb()
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'peak_child_rss_mb': peak_child_rss_mb}
+
+
+def _run_stage_process(stage, args):
+    """Run a stage in a fresh process so that its peak RSS is not affected by the other stages.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--n-jobs', str(args.n_jobs),
+               '--workdir', args.workdir]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _get_commit():
+    try:
+        command = ['git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', '--short', 'HEAD']
+        return subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(result, previous, tolerance=0.2):
+    """Log the stage times relative to a previous run. Stages slower by more than `tolerance` are flagged.
+    """
+    for stage, curr in result['stages'].items():
+        prev = previous['stages'].get(stage)
+        if prev is None:
+            continue
+
+        ratio = curr['seconds'] / max(prev['seconds'], 1e-9)
+        flag = ' REGRESSION' if ratio > 1 + tolerance else ''
+        log(f"{stage}: {prev['seconds']:.2f}s -> {curr['seconds']:.2f}s ({ratio:.2f}x){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workdir', default='./data/benchmark/', help='directory of the synthetic data and outputs.')
+    parser.add_argument('--results', default='./data/benchmark_results.jsonl', help='file the results are appended to.')
+    parser.add_argument('--sdate', default='2017-03-01')
+    parser.add_argument('--edate', default='2017-05-31')
+    parser.add_argument('--n-etfs', type=int, default=100)
+    parser.add_argument('--n-securities', type=int, default=5000)
+    parser.add_argument('--n-holdings', type=int, default=200, help='average number of holdings per ETF.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--stages', nargs='+', default=stages, choices=stages)
+    parser.add_argument('--regenerate', action='store_true', help='regenerate the synthetic data.')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)  # run a single stage and print the result as json.
+    args = parser.parse_args()
+
+    args.workdir = os.path.abspath(args.workdir)
+    args.results = os.path.abspath(args.results)
+    etfg_dir = os.path.join(args.workdir, 'etfg', '')
+    os.environ['ETFG_DIR'] = etfg_dir
+    os.environ['ETFG_OFFLINE'] = '1'
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)  # stage outputs are written to ./data/ and ./equity_data/.
+
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args.n_jobs)))
+        return
+
+    params = {key: getattr(args, key) for key in ['sdate', 'edate', 'n_etfs', 'n_securities', 'n_holdings', 'seed']}
+    params_path = os.path.join(args.workdir, 'params.json')
+    old_params = None
+    if os.path.exists(params_path):
+        with open(params_path, 'r') as f:
+            old_params = json.load(f)
+
+    if args.regenerate or (old_params != params):
+        import shutil
+        for dir in ['etfg', 'data', 'equity_data']:
+            shutil.rmtree(os.path.join(args.workdir, dir), ignore_errors=True)
+        os.makedirs('data', exist_ok=True)
+        log(f'Generating synthetic data: {params}')
+        counts = generate_etfg_data(etfg_dir, args.sdate, args.edate, args.n_etfs, args.n_securities,
+                                    args.n_holdings, args.seed)
+        with open(params_path, 'w') as f:
+            json.dump(params, f)
+        with open(os.path.join(args.workdir, 'counts.json'), 'w') as f:
+            json.dump(counts, f)
+
+    with open(os.path.join(args.workdir, 'counts.json'), 'r') as f:
+        counts = json.load(f)
+
+    result = {
+        'time': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'commit': _get_commit(),
+        'n_jobs': args.n_jobs,
+        'params': params,
+        'stages': {},
+    }
+    for stage in args.stages:
+        stats = _run_stage_process(stage, args)
+        stats['rows'] = counts[stage_inputs[stage]]
+        stats['rows_per_sec'] = stats['rows'] / max(stats['seconds'], 1e-9)
+        result['stages'][stage] = stats
+        log(f"{stage}: {stats['seconds']:.2f}s, {stats['rows_per_sec']:,.0f} rows/s, "
+            f"peak rss {stats['peak_rss_mb']} MB")
+
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results, 'r') as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        runs = [run for run in runs if (run['params'] == params) and (run['n_jobs'] == args.n_jobs)]
+        previous = runs[-1] if runs else None
+    if previous:
+        log(f"Compared with {previous['time']} ({previous['commit']}):")
+        compare_results(result, previous)
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
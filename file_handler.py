@@ -114,12 +114,10 @@ def gather_constituent_files():
         #     print(f'shape after: {df.shape}')
         #     df.to_pickle(f'data/constituents_{dir}_v2.pickle')
 
-import difflib
-from difflib import SequenceMatcher
+from file_handler2 import match_names, score_name_pairs, read_crsp_table
 
 def link_etfg_permno():
-    wrds = WRDS('fehouse')
-    stocknames = wrds.read_data('stocknames')
+    stocknames = read_crsp_table('stocknames')
     # holdings = pd.read_pickle('./data/constituents_2018_v2.pickle')
     with open("etfg_names.json", 'r') as f:
         etfg_names = json.load(f)
@@ -145,30 +143,26 @@ def link_etfg_permno():
     names2 = pd.Series(crsp_names, name='name').sort_values()
     names = pd.merge(names1, names2, on='name', how='inner')
     names = list(np.squeeze(names.values))
-    etfg_names = [name for name in etfg_names if name not in names]
+    exact_names = set(names)
+    etfg_names = [name for name in etfg_names if name not in exact_names]
 
     name_mapping = {name: name for name in names}
-    for i, name in enumerate(etfg_names):
-        try:
-            ret = difflib.get_close_matches(name, crsp_names, n=1, cutoff=0.7)
-            if ret:
-                name_mapping[name] = ret[0]
-                log(f'{i}/{len(etfg_names)}: {name} - {ret[0]}')
-        except Exception as e:
-            log(e)
+    matches = match_names(etfg_names, crsp_names, k=10, cutoff=0.7)
+    matches = matches.drop_duplicates('name')
+    name_mapping.update(zip(matches['name'], matches['candidate']))
+    log(f'{len(matches)}/{len(etfg_names)} names matched.')
 
     name_mapping = pd.Series(name_mapping)
     name_mapping.index.name = 'etfg_name'
     name_mapping = name_mapping.to_frame(name='crsp_name').reset_index()
-    name_mapping['match1'] = np.nan
-    name_mapping['match2'] = np.nan
+    scores = score_name_pairs(name_mapping['etfg_name'], name_mapping['crsp_name'])
+    name_mapping['match1'] = scores['match1'].to_numpy()
+    name_mapping['match2'] = scores['match2'].to_numpy()
     name_mapping['etfg_name2'] = name_mapping['etfg_name'].str[:10]
     name_mapping['crsp_name2'] = name_mapping['crsp_name'].str[:10]
-    for i in name_mapping.index:
-        print(f"{i}/{len(name_mapping)}: {name_mapping.loc[i, 'etfg_name']}")
-        name_mapping.loc[i, 'match1'] = SequenceMatcher(None, name_mapping.loc[i, 'etfg_name'], name_mapping.loc[i, 'crsp_name']).ratio()
-        name_mapping.loc[i, 'match2'] = SequenceMatcher(None, name_mapping.loc[i, 'crsp_name'], name_mapping.loc[i, 'etfg_name']).ratio()
-        name_mapping.loc[i, 'match3'] = SequenceMatcher(None, name_mapping.loc[i, 'crsp_name'], name_mapping.loc[i, 'etfg_name']).ratio()
+    name_mapping['match3'] = scores['match2'].to_numpy()
+    name_mapping['token_jaccard'] = scores['token_jaccard'].to_numpy()
+    name_mapping['ngram_cosine'] = scores['ngram_cosine'].to_numpy()
 
     name_mapping.to_pickle('data/name_mapping.pickle')
 
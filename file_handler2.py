@@ -1,16 +1,43 @@
 import pandas as pd
 import numpy as np
 import os
+import sys
+import shutil
 import json
+import re
+import hashlib
+import time
+import traceback
+import contextlib
+import cProfile
+import functools
+import operator
 import difflib
 from difflib import SequenceMatcher
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow
+import pyarrow.csv
+import pyarrow.dataset
+import pyarrow.parquet
+import scipy.sparse
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import psutil  # optional
+except ImportError:
+    psutil = None
 
 import pyanomaly as pa
 from pyanomaly.globals import *
 from pyanomaly.wrdsdata import WRDS
 
 # DIR = './etfg/'
-DIR = 'E:/etfg/'
+DIR = os.environ.get('ETFG_DIR', 'E:/etfg/')  # root of the ETFG files. See set_etfg_dir().
 DIR_CONSTITUENTS = DIR + 'constituents_us/'
 DIR_INDUSTRY = DIR + 'industry_us/'
 DIR_FUNDFLOW = DIR + 'fundflow_us/'
@@ -68,158 +95,1020 @@ v2_header_constituents_map = {
     'currency_traded': 'currency'
 }
 
-def read_profile_file(date):
-    if date < '2017-04-03':
-        type = 'export.csv'
-        header_path = DIR_LEGACY_HEADER + 'Legacy_Industry_Header.xlsx'
-        header_map = legacy_header_industry_map
-    else:
-        type = 'v2.csv'
-        header_path = DIR_V2_HEADER + 'industry_v2_header.xlsx'
-        header_map = v2_header_industry_map
+V2_START_DATE = '2017-04-03'  # files from this date are in the v2 format.
 
-    df = pd.read_csv(DIR_INDUSTRY + date[:4] + f"/{date.replace('-', '')}_industries_{type}", header=None)
-    header = pd.read_excel(header_path)
-    columns = [col.lower() for col in header.columns]
-    df.columns = columns
-    df = df.rename(columns=header_map)
+file_suffixes = {
+    'legacy': 'export.csv',
+    'v2': 'v2.csv',
+}
 
-    return df
+file_names = {
+    'industry': 'industries',
+    'fundflow': 'fundflow',
+    'constituents': 'constituents',
+}
 
-def read_fundflow_file(date):
-    if date < '2017-04-03':
-        type = 'export.csv'
-        header_path = DIR_LEGACY_HEADER + 'Legacy_Fund_Flow_Header.xlsx'
-        header_map = legacy_header_fundflow_map
-    else:
-        type = 'v2.csv'
-        header_path = DIR_V2_HEADER + 'fundflow_v2_header.xlsx'
-        header_map = v2_header_fundflow_map
+# dataset: {format: (header file, header map)}
+schemas = {
+    'industry': {
+        'legacy': ('Legacy_Industry_Header.xlsx', legacy_header_industry_map),
+        'v2': ('industry_v2_header.xlsx', v2_header_industry_map),
+    },
+    'fundflow': {
+        'legacy': ('Legacy_Fund_Flow_Header.xlsx', legacy_header_fundflow_map),
+        'v2': ('fundflow_v2_header.xlsx', v2_header_fundflow_map),
+    },
+    'constituents': {
+        'legacy': ('Legacy_Constituents_Header.xlsx', legacy_header_constituents_map),
+        'v2': ('constituent_v2_header.xlsx', v2_header_constituents_map),
+    },
+}
 
-    df = pd.read_csv(DIR_FUNDFLOW + date[:4] + f"/{date.replace('-', '')}_fundflow_{type}", header=None)
-    header = pd.read_excel(header_path)
-    columns = [col.lower() for col in header.columns]
-    df.columns = columns
-    df = df.rename(columns=header_map)
+# Column types after renaming: 'str', 'float', 'int8', or 'date', or {format: type} if the type depends on the file
+# format. Flags such as is_etn are 't'/'f' in legacy files and 1/0 in v2 files. Every column of the header files must
+# be listed here.
+flag_type = {'legacy': 'str', 'v2': 'int8'}
+column_types = {
+    # common
+    'date': 'date',
+    'etfg_date': 'date',
+    'ticker': 'str',
+    'composite_ticker': 'str',
+    'asset_class': 'str',
+    # industry
+    'issuer': 'str',
+    'description': 'str',
+    'inception_date': 'str',
+    'primary_benchmark': 'str',
+    'tax_classification': 'str',
+    'is_etn': flag_type,
+    'category': 'str',
+    'focus': 'str',
+    'development_class': 'str',
+    'region': 'str',
+    'is_levered': flag_type,
+    'levered_amount': 'float',
+    'is_active': flag_type,
+    'administrator': 'str',
+    'advisor': 'str',
+    'custodian': 'str',
+    'distributor': 'str',
+    'portfolio_manager': 'str',
+    'subadvisor': 'str',
+    'transfer_agent': 'str',
+    'trustee': 'str',
+    'futures_commission_merchant': 'str',
+    'fiscal_year_end': 'str',
+    'distribution_frequency': 'str',
+    'listing_exchange': 'str',
+    'creation_unit_size': 'float',
+    'creation_fee': 'float',
+    'lead_market_maker': 'str',
+    'aum': 'float',
+    'avg_daily_trading_volume': 'float',
+    'num_holdings': 'float',
+    # fundflow
+    'shrout': 'float',
+    'nav': 'float',
+    'fundflow': 'float',
+    # constituents
+    'name': 'str',
+    'weight': 'float',
+    'market_value': 'float',
+    'cusip': 'str',
+    'isin': 'str',
+    'figi': 'str',
+    'sedol': 'str',
+    'country': 'str',
+    'exchange': 'str',
+    'shares_held': 'float',
+    'security_type': 'str',
+    'currency': 'str',
+}
 
-    return df
+SCHEMA_CACHE_PATH = DATA_DIR + 'schema_cache.json'
+_headers = {}  # header file: columns. Headers loaded in this process.
 
-def read_constituents_file(date):
-    if date < '2017-04-03':
-        type = 'export.csv'
-        header_path = DIR_LEGACY_HEADER + 'Legacy_Constituents_Header.xlsx'
-        header_map = legacy_header_constituents_map
-    else:
-        type = 'v2.csv'
-        header_path = DIR_V2_HEADER + 'constituent_v2_header.xlsx'
-        header_map = v2_header_constituents_map
 
-    df = pd.read_csv(DIR_CONSTITUENTS + date[:4] + f"/{date.replace('-', '')}_constituents_{type}", header=None)
-    header = pd.read_excel(header_path)
-    columns = [col.lower() for col in header.columns]
-    df.columns = columns
-    df = df.rename(columns=header_map)
+def set_etfg_dir(dir):
+    """Set the root directory of the ETFG files, e.g., to a synthetic tree generated by benchmark.py.
 
-    return df
+    The directory is also set in the ETFG_DIR environment variable so that worker processes, which re-import this
+    module on platforms that spawn processes, use the same directory.
+    """
+    global DIR, DIR_CONSTITUENTS, DIR_INDUSTRY, DIR_FUNDFLOW, DIR_V2_HEADER, DIR_LEGACY_HEADER
+    DIR = os.path.join(dir, '')
+    DIR_CONSTITUENTS = DIR + 'constituents_us/'
+    DIR_INDUSTRY = DIR + 'industry_us/'
+    DIR_FUNDFLOW = DIR + 'fundflow_us/'
+    DIR_V2_HEADER = DIR + 'v2_header_files/'
+    DIR_LEGACY_HEADER = DIR + 'legacy_header_files/'
+    os.environ['ETFG_DIR'] = DIR
+
+
+def get_file_format(date):
+    return 'legacy' if date < V2_START_DATE else 'v2'
+
+
+def get_dataset_dir(dataset):
+    dirs = {
+        'industry': DIR_INDUSTRY,
+        'fundflow': DIR_FUNDFLOW,
+        'constituents': DIR_CONSTITUENTS,
+    }
+    return dirs[dataset]
+
+
+def get_file_path(dataset, date):
+    suffix = file_suffixes[get_file_format(date)]
+    return get_dataset_dir(dataset) + date[:4] + f"/{date.replace('-', '')}_{file_names[dataset]}_{suffix}"
+
+
+def read_header(dataset, format):
+    """Read the (lower-cased) columns of a header file.
+
+    Headers are loaded once per process and persisted to SCHEMA_CACHE_PATH. The Excel file is parsed only when it is
+    not in the cache or has been modified since it was cached.
+    """
+    header_file = schemas[dataset][format][0]
+    if header_file in _headers:
+        return _headers[header_file]
+
+    header_path = (DIR_LEGACY_HEADER if format == 'legacy' else DIR_V2_HEADER) + header_file
+    mtime = os.path.getmtime(header_path) if os.path.exists(header_path) else None
+
+    cache = {}
+    if os.path.exists(SCHEMA_CACHE_PATH):
+        with open(SCHEMA_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+
+    entry = cache.get(header_file)
+    if (entry is None) or (mtime is not None and entry['mtime'] != mtime):
+        header = pd.read_excel(header_path)
+        entry = {'mtime': mtime, 'columns': [col.lower() for col in header.columns]}
+        cache[header_file] = entry
+        os.makedirs(os.path.dirname(SCHEMA_CACHE_PATH), exist_ok=True)
+        tmp_path = f'{SCHEMA_CACHE_PATH}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, SCHEMA_CACHE_PATH)
+
+    _headers[header_file] = entry['columns']
+    return entry['columns']
+
+
+def get_schema(dataset, format):
+    """Get the renamed columns and their types of a dataset.
+
+    Returns:
+        columns, types: List of columns and dict of {column: type}.
+    """
+    header_map = {raw.lower(): col for raw, col in schemas[dataset][format][1].items()}  # headers are lower-cased.
+    columns = [header_map.get(col, col) for col in read_header(dataset, format)]
+    missing = [col for col in columns if col not in column_types]
+    if missing:
+        raise KeyError(f'{dataset} ({format}): no type in column_types for {missing}.')
+
+    types = {col: column_types[col] if isinstance(column_types[col], str) else column_types[col][format]
+             for col in columns}
+    return columns, types
+
+
+def read_etfg_file(dataset, date, columns=None):
+    """Read an ETFG daily file of `dataset` ('industry', 'fundflow', or 'constituents').
+
+    Files are parsed by the multithreaded pyarrow csv reader. Only `columns` are parsed, and the columns are renamed and
+    typed at read time according to the schema of the file format: dates are parsed to datetime64 and empty strings
+    are read as null.
+
+    Args:
+        dataset: Dataset name.
+        date: Date string.
+        columns: List of (renamed) columns to read. If None, read all columns.
+
+    Returns:
+        DataFrame with `columns` in the given order.
+    """
+    all_columns, types = get_schema(dataset, get_file_format(date))
+    columns = columns or all_columns
+    arrow_types = {'str': pyarrow.string(), 'float': pyarrow.float64(), 'int8': pyarrow.int8(),
+                   'date': pyarrow.timestamp('ns')}
+    column_types = {col: arrow_types[types[col]] for col in columns}
+
+    path = get_file_path(dataset, date)
+    with span('read', date, dataset=dataset) as s:
+        table = pyarrow.csv.read_csv(
+            path,
+            read_options=pyarrow.csv.ReadOptions(column_names=all_columns),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=column_types, include_columns=columns,
+                                                       strings_can_be_null=True),
+        )
+        s.set(rows=table.num_rows, bytes=os.path.getsize(path))
+        return table.to_pandas()
 
-def get_avaiable_dates(sdate=None, edate=None):
+
+def read_profile_file(date, columns=None):
+    return read_etfg_file('industry', date, columns)
+
+
+def read_fundflow_file(date, columns=None):
+    return read_etfg_file('fundflow', date, columns)
+
+
+def read_constituents_file(date, columns=None):
+    return read_etfg_file('constituents', date, columns)
+
+
+CATALOG_PATH = DATA_DIR + 'file_catalog.json'
+_catalog = None  # catalog loaded in this process.
+
+
+def _scan_year_dir(dataset, path):
+    """Scan a year directory of a dataset: {date: {'format': format, 'size': size, 'mtime': mtime}}.
+    """
+    suffixes = {suffix: format for format, suffix in file_suffixes.items()}
+    pattern = re.compile(r'(\d{4})(\d{2})(\d{2})_' + file_names[dataset] + '_(.+)')
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            m = pattern.fullmatch(entry.name)
+            if not m or m.group(4) not in suffixes or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            date = f'{m.group(1)}-{m.group(2)}-{m.group(3)}'
+            files[date] = {'format': suffixes[m.group(4)], 'size': stat.st_size, 'mtime': stat.st_mtime}
+    return files
+
+
+def refresh_file_catalog(dataset):
+    """Refresh the catalog of a dataset and save it to CATALOG_PATH.
+
+    The catalog records the date, format, size, and mtime of each file, grouped by year directory. Only the year
+    directories whose mtime has changed, i.e., files have been added, removed, or renamed, are rescanned. Files
+    modified in place are detected by the manifests of the processing stages. If the dataset directory is not
+    available, e.g., the drive is not mounted, the saved catalog is used as is.
+
+    Returns:
+        {year: {'mtime': mtime, 'files': {date: {'format': format, 'size': size, 'mtime': mtime}}}}
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = {}
+        if os.path.exists(CATALOG_PATH):
+            with open(CATALOG_PATH, 'r') as f:
+                _catalog = json.load(f)
+
+    root = get_dataset_dir(dataset)
+    old = _catalog.get(dataset, {})
+    if not os.path.isdir(root):
+        log(f'{root} is not available. The saved catalog is used.')
+        return old
+
+    new = {}
+    for year in sorted(os.listdir(root)):
+        path = root + year
+        if not re.fullmatch(r'\d{4}', year) or not os.path.isdir(path):
+            continue
+
+        mtime = os.path.getmtime(path)
+        if (year in old) and (old[year]['mtime'] == mtime):
+            new[year] = old[year]
+        else:
+            new[year] = {'mtime': mtime, 'files': _scan_year_dir(dataset, path)}
+
+    if new != old:
+        _catalog[dataset] = new
+        os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+        with open(CATALOG_PATH + '.tmp', 'w') as f:
+            json.dump(_catalog, f)
+        os.replace(CATALOG_PATH + '.tmp', CATALOG_PATH)
+
+    return new
+
+
+def get_file_catalog(dataset, sdate=None, edate=None):
+    """Get the files of a dataset available between `sdate` and `edate` (inclusive).
+
+    Returns:
+        DataFrame of date, format, size, and mtime sorted by date.
+    """
     sdate = sdate or '2000-01-01'
     edate = edate or '2099-12-31'
 
-    dates = []
-    years = os.listdir(DIR_FUNDFLOW)
-    for year in years:
-        if not os.path.isdir(DIR_CONSTITUENTS + year):
+    catalog = refresh_file_catalog(dataset)
+    files = [{'date': date, **info} for year in catalog.values() for date, info in year['files'].items()
+             if (date >= sdate) and (date <= edate)]
+    return pd.DataFrame(files, columns=['date', 'format', 'size', 'mtime']).sort_values('date', ignore_index=True)
+
+
+def get_avaiable_dates(sdate=None, edate=None, dataset='constituents'):
+    """Get the sorted dates of the files of `dataset` available between `sdate` and `edate` (inclusive).
+    """
+    return get_file_catalog(dataset, sdate, edate)['date'].tolist()
+
+
+# Shared dictionaries of identifier columns: {dataset: {column: dictionary}}. Identifiers are stored as categoricals
+# whose categories are the dictionary, so the category codes are integer IDs shared across partitions and runs.
+dataset_dictionaries = {
+    'holdings': {'composite_ticker': 'etf', 'cusip': 'security'},
+    'fundflow': {'ticker': 'etf'},
+    'flow_demand': {'cusip': 'security'},
+    'holdings_diff': {'composite_ticker': 'etf', 'cusip': 'security'},
+    'holdings_qa': {'composite_ticker': 'etf'},
+    'holdings_by_security': {'composite_ticker': 'etf', 'cusip': 'security'},
+}
+
+# Narrowest safe dtypes of numeric columns. Weights need no more than float32 precision; dollar values and share
+# counts do. PERMNOs are 5-digit integers.
+compact_dtypes = {
+    'weight': 'float32',
+    'market_value': 'float64',
+    'shares_held': 'float64',
+    'shrout': 'float64',
+    'nav': 'float64',
+    'fundflow': 'float64',
+    'demand': 'float64',
+    'permno': 'Int32',
+}
+
+_dictionaries = {}  # dictionaries loaded in this process.
+
+
+def get_dictionary(name, values=None):
+    """Get a shared dictionary, e.g., 'etf' or 'security'.
+
+    Dictionaries are append-only, so the position (ID) of a value never changes.
+
+    Args:
+        name: Dictionary name.
+        values: Values to add. New values are appended and the dictionary is saved.
+
+    Returns:
+        Index of the dictionary values.
+    """
+    path = DATA_DIR + f'dict_{name}.pickle'
+    if name not in _dictionaries:
+        _dictionaries[name] = pd.read_pickle(path) if os.path.exists(path) else pd.Index([], dtype=object)
+
+    dictionary = _dictionaries[name]
+    if values is not None:
+        values = pd.Index(pd.unique(np.asarray(values, dtype=object))).dropna()
+        new = values[~values.isin(dictionary)]
+        if len(new):
+            dictionary = dictionary.append(new)
+            _dictionaries[name] = dictionary
+            pd.to_pickle(dictionary, path)
+
+    return dictionary
+
+
+def compact_frame(df, name, update=False):
+    """Convert a frame of dataset `name` to the compact representation.
+
+    Identifier columns become categoricals over the shared dictionaries (see `dataset_dictionaries`), and numeric
+    columns are cast to `compact_dtypes`.
+
+    Args:
+        df: DataFrame.
+        name: Dataset name.
+        update: If True, add new identifiers to the dictionaries. Otherwise, new identifiers are appended to the
+            categories of `df` only.
+
+    Returns:
+        Compact DataFrame.
+    """
+    df = df.copy()
+    for col, dictionary in dataset_dictionaries.get(name, {}).items():
+        if col not in df:
             continue
 
-        for root, years, files in os.walk(DIR_CONSTITUENTS + year):
-            for file in files:
-                date = file[:4] + '-' + file[4:6] + '-' + file[6:8]
-                if (date >= sdate) and (date <= edate):
-                    dates.append(date)
+        is_categorical = isinstance(df[col].dtype, pd.CategoricalDtype)
+        if is_categorical:
+            unique = pd.Index(df[col].cat.categories, dtype=object)
+        else:
+            unique = pd.Index(pd.unique(np.asarray(df[col], dtype=object))).dropna()
+
+        categories = get_dictionary(dictionary, unique if update else None)
+        if not update:
+            categories = categories.append(unique[~unique.isin(categories)])
+
+        if is_categorical:
+            df[col] = df[col].cat.set_categories(categories)
+        else:
+            df[col] = pd.Categorical(df[col], categories=categories)
+
+    for col, dtype in compact_dtypes.items():
+        if col in df:
+            df[col] = df[col].astype(dtype)
 
-    return dates
+    return df
 
 
-def process_profile_files(sdate=None, edate=None):
+def sort_frame(df, sort_by):
+    """Sort `df` by `sort_by`. Categorical columns are sorted by their values, not by their codes.
     """
+    def key(col):
+        if not isinstance(col.dtype, pd.CategoricalDtype):
+            return col
+        rank = np.argsort(np.argsort(col.cat.categories.to_numpy(dtype=object), kind='stable'), kind='stable')
+        rank = np.append(rank, len(rank))  # nan (code = -1) last
+        return pd.Series(rank[col.cat.codes.to_numpy()], index=col.index)
+
+    return df.sort_values(sort_by, key=key)
+
+
+ROW_GROUP_SIZE = 100000  # rows per parquet row group.
+
+
+def get_partition_dir(name, year, month, data_dir=None):
+    return (data_dir or DATA_DIR) + f'{name}/year={year}/month={month}/'
+
+
+def list_partitions(name, data_dir=None):
+    """List the (year, month) partitions of a dataset in chronological order.
     """
-    const_columns = [  # columns whose values are time-invariant
-        'ticker',
-        'issuer',
-        'description',
-        'inception_date',
-        'primary_benchmark',
-        'tax_classification',
-        'is_etn',
-        'asset_class',
-        'category',
-        'focus',
-        'development_class',
-        'region',
-        'is_levered',
-        'levered_amount',
-        'is_active',
-        'administrator',
-        'advisor',
-        'custodian',
-        'distributor',
-        'portfolio_manager',
-        'subadvisor',
-        'transfer_agent',
-        'trustee',
-        'futures_commission_merchant',
-        'fiscal_year_end',
-        'distribution_frequency',
-        'listing_exchange',
-        'creation_unit_size',
-        'creation_fee',
-        'lead_market_maker',
-        'date',
-    ]
+    dir = (data_dir or DATA_DIR) + name + '/'
+    if not os.path.isdir(dir):
+        return []
 
-    dates = get_avaiable_dates(sdate, edate)
-    df_list = []
+    partitions = []
+    for year_dir in os.listdir(dir):
+        if not re.fullmatch(r'year=\d+', year_dir):
+            continue
+        for month_dir in os.listdir(dir + year_dir):
+            if re.fullmatch(r'month=\d+', month_dir):
+                partitions.append((int(year_dir[5:]), int(month_dir[6:])))
+
+    return sorted(partitions)
+
+
+def write_partition(df, name, year, month, data_dir=None):
+    """Write `df` as the (year, month) partition of a dataset, replacing the existing partition.
+    """
+    dir = get_partition_dir(name, year, month, data_dir)
+    os.makedirs(dir, exist_ok=True)
+    df = compact_frame(df.drop(columns=['year', 'month'], errors='ignore'), name, update=True)
+    for col in dataset_dictionaries.get(name, {}):
+        if col in df:  # Only the used values are stored. Codes are restored when the partition is read.
+            df[col] = df[col].cat.remove_unused_categories()
+    with span('write', dataset=name, partition=(year, month)) as s:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        pyarrow.parquet.write_table(table, dir + '.part-0.parquet', row_group_size=ROW_GROUP_SIZE)
+        os.replace(dir + '.part-0.parquet', dir + 'part-0.parquet')
+        s.set(rows=len(df), bytes=os.path.getsize(dir + 'part-0.parquet'))
+
+
+def write_dataset(df, name, sort_by=None, data_dir=None):
+    """Write `df` as a parquet dataset partitioned by the year and month of `date`.
+
+    The partitions in `df` are replaced and the other partitions of the dataset are kept. Rows are sorted by `sort_by`
+    within each partition so that row-group statistics can be used to skip row groups when reading.
+
+    Args:
+        df: DataFrame with 'date' column.
+        name: Dataset name, e.g., 'holdings'.
+        sort_by: Columns to sort by.
+        data_dir: Root directory of the dataset. Default to DATA_DIR.
+    """
+    if sort_by:
+        df = sort_frame(df, sort_by)
+
+    for (year, month), g in df.groupby([df['date'].dt.year, df['date'].dt.month]):
+        write_partition(g, name, year, month, data_dir)
+
+
+def open_dataset(name, data_dir=None):
+    dir = (data_dir or DATA_DIR) + name + '/'
+    dataset = pyarrow.dataset.dataset(dir, format='parquet', partitioning='hive')
+    # Partitions can have different columns, e.g., permno is added by link_etfg_permno().
+    schema = pyarrow.unify_schemas([dataset.schema] + [f.physical_schema for f in dataset.get_fragments()])
+    return pyarrow.dataset.dataset(dir, schema=schema, format='parquet', partitioning='hive')
+
+
+def read_dataset(name, columns=None, sdate=None, edate=None, filters=None, data_dir=None):
+    """Read a parquet dataset with column and predicate pushdown.
+
+    Only the partitions in the date range are scanned, and row groups are skipped using their statistics.
+
+    Args:
+        name: Dataset name, e.g., 'holdings'.
+        columns: List of columns to read. If None, read all columns.
+        sdate: Start date (inclusive).
+        edate: End date (inclusive).
+        filters: Dict of {column: values}, e.g., {'composite_ticker': ['SPY', 'IVV']}. Rows whose column value is in
+            values are read.
+        data_dir: Root directory of the dataset. Default to DATA_DIR.
+
+    Returns:
+        DataFrame.
+    """
+    dataset = open_dataset(name, data_dir)
+    year, month = pyarrow.dataset.field('year'), pyarrow.dataset.field('month')
+    date_type = dataset.schema.field('date').type
+
+    exprs = []
+    if sdate:
+        sdate = pd.Timestamp(sdate)
+        exprs.append((year > sdate.year) | ((year == sdate.year) & (month >= sdate.month)))
+        exprs.append(pyarrow.dataset.field('date') >= pyarrow.scalar(sdate, date_type))
+    if edate:
+        edate = pd.Timestamp(edate)
+        exprs.append((year < edate.year) | ((year == edate.year) & (month <= edate.month)))
+        exprs.append(pyarrow.dataset.field('date') <= pyarrow.scalar(edate, date_type))
+    for col, values in (filters or {}).items():
+        exprs.append(pyarrow.dataset.field(col).isin(list(values)))
+
+    expr = functools.reduce(operator.and_, exprs) if exprs else None
+    if columns is None:
+        columns = [col for col in dataset.schema.names if col not in ('year', 'month')]
+
+    return compact_frame(dataset.to_table(columns=columns, filter=expr).to_pandas(), name)
+
+
+def read_partition(name, year, month, columns=None, filters=None, data_dir=None):
+    """Read the (year, month) partition of a dataset. See read_dataset() for the arguments.
+    """
+    path = get_partition_dir(name, year, month, data_dir) + 'part-0.parquet'
+    filters = [(col, 'in', list(values)) for col, values in (filters or {}).items()] or None
+    return compact_frame(pyarrow.parquet.read_table(path, columns=columns, filters=filters).to_pandas(), name)
+
+
+def update_dataset(df, name, dates, sort_by=None, data_dir=None):
+    """Update the partitions of a dataset that contain `dates`.
+
+    In each affected partition, the existing rows of `dates` are replaced by the rows of `df` and the rows of the other
+    dates are kept.
+
+    Args:
+        df: DataFrame with 'date' column. Rows of `dates`.
+        name: Dataset name.
+        dates: List of dates to replace.
+        sort_by: Columns to sort by within each partition.
+        data_dir: Root directory of the dataset. Default to DATA_DIR.
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    partitions = set(zip(dates.dt.year, dates.dt.month))
+    for year, month in sorted(partitions):
+        new = df[(df['date'].dt.year == year) & (df['date'].dt.month == month)]
+        if (year, month) in list_partitions(name, data_dir):
+            old = read_partition(name, year, month, data_dir=data_dir)
+            new = pd.concat([old[~old['date'].isin(dates)], new])
+        if sort_by:
+            new = sort_frame(new, sort_by)
+        write_partition(new, name, year, month, data_dir)
+
+
+def prune_partitions(name, dates, data_dir=None):
+    """Remove the partitions of a dataset that contain none of `dates`, e.g., after the dataset is rebuilt from the files
+    of `dates`, the partitions of the months whose files are gone.
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    keep = set(zip(dates.dt.year, dates.dt.month))
+    for year, month in list_partitions(name, data_dir):
+        if (year, month) not in keep:
+            shutil.rmtree(get_partition_dir(name, year, month, data_dir))
+            log(f'{name}: removed partition {year}-{month:02d}.')
+
+
+class PartitionWriter:
+    """Write a dataset partition by partition as dates advance.
+
+    Frames are buffered until a frame of a new (year, month) partition is added, and then the buffered partition is
+    sorted and written. Frames must be added in date order. Memory is bounded by one partition.
+
+    Args:
+        name: Dataset name.
+        sort_by: Columns to sort by within each partition.
+        update: If True, only the rows of the added dates are replaced in each partition (see update_dataset()).
+            Otherwise, partitions are replaced.
+        data_dir: Root directory of the dataset. Default to DATA_DIR.
+    """
+
+    def __init__(self, name, sort_by=None, update=False, data_dir=None):
+        self.name = name
+        self.sort_by = sort_by
+        self.update = update
+        self.data_dir = data_dir
+        self.partition = None
+        self.dates = []
+        self.frames = []
+
+    def add(self, date, df):
+        partition = (int(date[:4]), int(date[5:7]))
+        if partition != self.partition:
+            self.flush()
+            self.partition = partition
+
+        self.dates.append(date)
+        self.frames.append(compact_frame(df, self.name, update=True))
+
+    def flush(self):
+        if not self.frames:
+            return
+
+        # Align the categories, which may have grown since a frame was added.
+        df = pd.concat([compact_frame(frame, self.name) for frame in self.frames])
+        if self.update:
+            update_dataset(df, self.name, self.dates, self.sort_by, self.data_dir)
+        else:
+            if self.sort_by:
+                df = sort_frame(df, self.sort_by)
+            write_partition(df, self.name, *self.partition, self.data_dir)
+
+        self.dates = []
+        self.frames = []
+
+
+def get_manifest_path(stage):
+    return DATA_DIR + f'manifest_{stage}.json'
+
+
+def load_manifest(stage):
+    """Load the manifest of a stage: {date: {'size': size, 'mtime': mtime, 'hash': hash}} of the processed files.
+    """
+    path = get_manifest_path(stage)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(stage, manifest):
+    path = get_manifest_path(stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(sorted(manifest.items())), f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def get_file_signature(path, old=None, hash=True):
+    """Get the size, mtime, and sha1 hash of a file.
+
+    If the size and mtime are the same as those of `old`, `old` is returned without hashing the file. If `hash` is
+    False, the file is not read and the hash is None.
+    """
+    stat = os.stat(path)
+    if old and (old['size'] == stat.st_size) and (old['mtime'] == stat.st_mtime):
+        return old
+    if not hash:
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None}
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha1.hexdigest()}
+
+
+def get_pending_dates(dataset, dates, manifest, hash=True):
+    """Find the dates whose files are new or have changed since they were recorded in `manifest`.
+
+    Files whose mtime has changed but content has not are not pending: only their records in `manifest` are updated.
+    If `hash` is False, e.g., when all dates are processed anyway, the files are only stat-ed and their hashes are
+    None. Such records are hashed in a later run only if their size or mtime has changed.
+
+    Returns:
+        pending, signatures: List of pending dates and dict of {date: signature} of the files.
+    """
+    pending = []
+    signatures = {}
     for date in dates:
-        print(date)
+        old = manifest.get(date)
         try:
-            df = read_profile_file(date)
-        except Exception as e:
-            print(e)
+            signatures[date] = get_file_signature(get_file_path(dataset, date), old, hash)
+        except OSError:  # Missing file: let the reader fail and report it.
+            pending.append(date)
             continue
 
-        df = df[const_columns]
-        df = df.groupby('ticker').last()
+        if (old is None) or (old['hash'] != signatures[date]['hash']):
+            pending.append(date)
+        else:
+            manifest[date] = signatures[date]
+
+    return pending, signatures
+
+
+def update_manifest(manifest, dates, processed, signatures):
+    """Replace the records of `dates` in `manifest` with the signatures of the `processed` dates.
+    """
+    for date in dates:
+        manifest.pop(date, None)
+    for date in processed:
+        if date in signatures:
+            manifest[date] = signatures[date]
+
+
+def is_appending(pending, manifest):
+    """Check whether all pending dates are later than the dates already processed.
+    """
+    pending_set = set(pending)
+    done = [date for date in manifest if date not in pending_set]
+    return (not done) or (min(pending) > max(done))
+
+
+EVENTS_PATH = os.environ.get('ETFG_EVENTS', DATA_DIR + 'events.jsonl')  # machine-readable log of the spans.
+PROFILE_STAGE = os.environ.get('ETFG_PROFILE')  # stage to run under cProfile, e.g., 'holdings'.
+_stage = None  # stage running in this process.
+
+
+def get_peak_rss_mb(children=False):
+    """Peak RSS in MB of this process, or of its largest terminated child if `children` = True. None if not available.
+    """
+    if resource is not None:
+        unit = 1 if sys.platform == 'darwin' else 2 ** 10  # ru_maxrss is in bytes on macOS and KB on Linux.
+        who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+        return resource.getrusage(who).ru_maxrss * unit / 2 ** 20
+    if (psutil is not None) and not children:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2 ** 20  # peak_wset: Windows only
+    return None
+
+
+def get_memory_mb():
+    """Current and peak RSS of this process in MB. None if not available.
+    """
+    rss = psutil.Process().memory_info().rss / 2 ** 20 if psutil is not None else None
+    return rss, get_peak_rss_mb()
+
+
+def emit_event(event, **fields):
+    """Append an event to EVENTS_PATH as a json line.
+    """
+    record = {'time': time.time(), 'event': event, 'stage': _stage, 'pid': os.getpid(), **fields}
+    os.makedirs(os.path.dirname(EVENTS_PATH), exist_ok=True)
+    with open(EVENTS_PATH, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+class Span:
+    """Fields of a span, e.g., rows and bytes, set while the span is open.
+    """
+
+    def __init__(self, name, date=None, **fields):
+        self.name = name
+        self.date = date
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+@contextlib.contextmanager
+def span(name, date=None, **fields):
+    """Time a block and emit a 'span' event with its elapsed time, memory, and the fields set on the span.
+
+    Spans are named by the step, e.g., 'read', 'transform', 'dedup', 'merge', or 'write', and are tagged with the
+    running stage. If the block raises, an 'error' event with the traceback is emitted (once, by the innermost span)
+    and the exception is re-raised.
+
+    Usage:
+        with span('read', date) as s:
+            df = ...
+            s.set(rows=len(df))
+    """
+    s = Span(name, date, **fields)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield s
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        if not getattr(e, '_etfg_reported', False):
+            emit_event('error', span=name, date=date, error=error, traceback=traceback.format_exc(), **s.fields)
+            e._etfg_reported = True
+        raise
+    finally:
+        rss, peak = get_memory_mb()
+        emit_event('span', span=name, date=date, seconds=time.perf_counter() - start, rss_mb=rss, peak_rss_mb=peak,
+                   error=error, **s.fields)
+
+
+def instrumented(stage):
+    """Decorator of a stage function. The call is recorded as a 'stage' span, and the spans inside are tagged with
+    `stage`. If `stage` is PROFILE_STAGE, the call runs under cProfile and the stats are saved to
+    DATA_DIR/profile_{stage}.prof. Workers are not profiled, so profile with `n_jobs` = 1.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _stage
+            prev_stage, _stage = _stage, stage
+            profiler = cProfile.Profile() if stage == PROFILE_STAGE else None
+            start = time.perf_counter()
+            try:
+                with span('stage', args=args, kwargs=kwargs):
+                    if profiler:
+                        profiler.enable()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        if profiler:
+                            profiler.disable()
+                            profiler.dump_stats(DATA_DIR + f'profile_{stage}.prof')
+            finally:
+                log(f'{stage}: {time.perf_counter() - start:.1f}s, peak rss: {get_memory_mb()[1]} MB')
+                _stage = prev_stage
+
+        return wrapper
+
+    return decorator
+
+
+def _apply(func, item, stage=None):
+    global _stage
+    _stage = stage or _stage
+    try:
+        with span('date', item):
+            return func(item), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def map_dates(func, dates, n_jobs=1, initializer=None, initargs=()):
+    """Apply `func` to each date, serially or across a process pool.
+
+    Yields (date, result, error) in date order, so the parallel path produces the same output as the serial path.
+    Each date is recorded as a 'date' span. Exceptions are caught per date, emitted as 'error' events with their
+    traceback, and returned in `error` instead of stopping the loop. At most 2 * `n_jobs` dates are
+    in flight, so memory stays bounded when the results are consumed as they are yielded.
+
+    Args:
+        func: Module-level function of a date.
+        dates: List of dates.
+        n_jobs: Number of worker processes. If 1, dates are processed serially in this process.
+        initializer: Function called once in each worker (or in this process if `n_jobs` = 1) before processing.
+        initargs: Arguments of `initializer`.
+    """
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs, initializer=initializer, initargs=initargs) as executor:
+            futures = deque()
+            for date in dates:
+                futures.append((date, executor.submit(_apply, func, date, _stage)))
+                if len(futures) >= 2 * n_jobs:
+                    date, future = futures.popleft()
+                    yield (date,) + future.result()
+            while futures:
+                date, future = futures.popleft()
+                yield (date,) + future.result()
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        for date in dates:
+            yield (date,) + _apply(func, date)
+
+
+failed_items = {}  # stage: number of dates (or partitions) that failed in this process.
+
+
+def report_failures(stage, failures):
+    if not failures:
+        return
+
+    failed_items[stage] = failed_items.get(stage, 0) + len(failures)
+    log(f'{stage}: {len(failures)} dates failed.')
+    for date, error in failures:
+        log(f'{stage}: {date}: {error}')
+
+
+profile_columns = [  # columns whose values are time-invariant
+    'ticker',
+    'issuer',
+    'description',
+    'inception_date',
+    'primary_benchmark',
+    'tax_classification',
+    'is_etn',
+    'asset_class',
+    'category',
+    'focus',
+    'development_class',
+    'region',
+    'is_levered',
+    'levered_amount',
+    'is_active',
+    'administrator',
+    'advisor',
+    'custodian',
+    'distributor',
+    'portfolio_manager',
+    'subadvisor',
+    'transfer_agent',
+    'trustee',
+    'futures_commission_merchant',
+    'fiscal_year_end',
+    'distribution_frequency',
+    'listing_exchange',
+    'creation_unit_size',
+    'creation_fee',
+    'lead_market_maker',
+    'date',
+]
+
+
+def _process_profile_file(date):
+    df = read_profile_file(date, profile_columns)
+    with span('transform', date):
+        return df.groupby('ticker').last()
+
+
+@instrumented('profile')
+def process_profile_files(sdate=None, edate=None, n_jobs=1, incremental=False):
+    """
+    If `incremental` is True, only the dates whose files are new or have changed since the last run are processed. If
+    any of them is earlier than the last processed date, all dates are processed. Otherwise, the profile is rebuilt from
+    the dates between `sdate` and `edate`. If no date is processed, the saved profile is kept.
+    """
+    dates = get_avaiable_dates(sdate, edate, 'industry')
+    manifest = load_manifest('profile')
+    pending, signatures = get_pending_dates('industry', dates, manifest, hash=incremental)
+    df_list = []
+    rebuild = True
+    if incremental:
+        if not pending:
+            log('profile: no new files.')
+            save_manifest('profile', manifest)
+            return pd.read_pickle(f'data/profile.pickle')
+
+        if is_appending(pending, manifest) and os.path.exists(f'data/profile.pickle'):
+            dates = pending
+            df_list.append(pd.read_pickle(f'data/profile.pickle').rename(columns={'last_date': 'date'}))
+            rebuild = False
+
+    processed = []
+    failures = []
+    for date, df, error in map_dates(_process_profile_file, dates, n_jobs):
+        if error:
+            failures.append((date, error))
+            continue
 
         df_list.append(df)
+        processed.append(date)
+    report_failures('profile', failures)
+    if not processed:  # failed dates stay out of the manifest and are retried in the next run.
+        update_manifest(manifest, dates, processed, signatures)
+        save_manifest('profile', manifest)
+        return pd.read_pickle(f'data/profile.pickle') if os.path.exists(f'data/profile.pickle') else None
+    if rebuild:  # the profile is rebuilt from `dates` only, so the other dates are no longer done.
+        manifest.clear()
 
     df = pd.concat(df_list)
     df = df.groupby('ticker').last()
     df = df.rename(columns={'date': 'last_date'})
     df.to_pickle(f'data/profile.pickle')
+    update_manifest(manifest, dates, processed, signatures)
+    save_manifest('profile', manifest)
     return df
 
 
-def process_fundflow_files(sdate=None, edate=None):
+def _process_fundflow_file(date):
+    return read_fundflow_file(date, ['date', 'ticker', 'shrout', 'nav', 'fundflow'])
+
+
+@instrumented('fundflow')
+def process_fundflow_files(sdate=None, edate=None, n_jobs=1, incremental=False):
     """
+    If `incremental` is True, only the dates whose files are new or have changed since the last run are processed, and
+    only the partitions containing them are rewritten. Otherwise, if `sdate` or `edate` is given, the rows of the dates
+    in the range are replaced and the other dates are kept, and if neither is given, the dataset is rebuilt.
     """
-    dates = get_avaiable_dates(sdate, edate)
+    dates = get_avaiable_dates(sdate, edate, 'fundflow')
+    manifest = load_manifest('fundflow')
+    pending, signatures = get_pending_dates('fundflow', dates, manifest, hash=incremental)
+    if incremental:
+        dates = pending
+        if not dates:
+            log('fundflow: no new files.')
+            save_manifest('fundflow', manifest)
+            return None
+
     df_list = []
-    for date in dates:
-        print(date)
-        try:
-            df = read_fundflow_file(date)
-        except Exception as e:
-            print(e)
+    processed = []
+    failures = []
+    for date, df, error in map_dates(_process_fundflow_file, dates, n_jobs):
+        if error:
+            failures.append((date, error))
             continue
 
-        df = df[['date', 'ticker', 'shrout', 'nav', 'fundflow']]
         df_list.append(df)
+        processed.append(date)
+    report_failures('fundflow', failures)
+    if not df_list:  # failed dates stay out of the manifest and are retried in the next run.
+        update_manifest(manifest, dates, processed, signatures)
+        save_manifest('fundflow', manifest)
+        return None
 
     df = pd.concat(df_list)
     df = df.sort_values(['ticker', 'date'])
-    df['date'] = pd.to_datetime(df['date'])
-    df.to_pickle(f'data/fundflow.pickle')
+    if incremental or sdate or edate:
+        update_dataset(df, 'fundflow', processed, ['ticker', 'date'])
+    else:
+        write_dataset(df, 'fundflow')
+        prune_partitions('fundflow', dates)
+        manifest.clear()  # the dates whose files are gone are no longer in the dataset.
+    update_manifest(manifest, dates, processed, signatures)
+    save_manifest('fundflow', manifest)
     return df
 
 
@@ -237,11 +1126,143 @@ def cleanse_ticker(ticker):
     return ticker
 
 
-v_cleanse_ticker = np.vectorize(cleanse_ticker)
+def cleanse_tickers(tickers):
+    """Vectorized version of cleanse_ticker().
 
+    The rules of cleanse_ticker() are applied to the distinct tickers using pandas string operations, and the results
+    are mapped back to `tickers`. Since the number of distinct tickers is small compared to the number of rows, this is
+    much faster than np.vectorize(cleanse_ticker).
 
-def process_constituent_files1(sdate=None, edate=None):
+    Args:
+        tickers: Array-like of tickers.
+
+    Returns:
+        Ndarray (object) of cleansed tickers. Invalid tickers are ''.
     """
+    codes, uniques = pd.factorize(np.asarray(tickers, dtype=object))  # None and nan are coded as -1.
+    uniques = pd.Series(uniques, dtype=object)
+
+    cleansed = pd.Series('', index=uniques.index, dtype=object)
+    is_str = uniques.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    ticker = uniques[is_str].str.strip('*')
+    ticker = ticker[ticker.str.isalpha()]
+    ticker = ticker.str.split().str[0].str[:5]
+    ticker = ticker[~ticker.str.isdecimal()]
+    cleansed[ticker.index] = ticker
+
+    cleansed = np.append(cleansed.to_numpy(), '')  # codes = -1 -> ''
+    return cleansed[codes]
+
+
+def check_cleanse_tickers(dates=(), n=100000, seed=0):
+    """Check that cleanse_tickers() gives the same results as cleanse_ticker().
+
+    The check is run on random synthetic tickers and the tickers in the constituents files of `dates`.
+
+    Returns:
+        True if the results are identical.
+    """
+    rng = np.random.default_rng(seed)
+    chars = np.array(list('ABCXYZabc019* .-/\u00c9\u00df\u0661'))
+    tickers = [''.join(rng.choice(chars, rng.integers(0, 9))) for _ in range(n)]
+    tickers += [None, np.nan, 1.5, '', '*', '**ABC*', 'BRK B', 'BRK.B', 'ABCDEFG', '12345', 'AB1', ' ABC']
+    samples = {'synthetic': tickers}
+    for date in dates:
+        samples[date] = read_constituents_file(date, ['ticker'])['ticker'].tolist()
+
+    passed = True
+    for sample, tickers in samples.items():
+        expected = np.array([cleanse_ticker(ticker) for ticker in tickers], dtype=object)
+        mismatch = expected != cleanse_tickers(tickers)
+        log(f'{sample}: {mismatch.sum()}/{len(tickers)} mismatches.')
+        if mismatch.any():
+            log(f'{sample}: {list(np.array(tickers, dtype=object)[mismatch][:10])}')
+            passed = False
+
+    return passed
+
+
+security_key_columns = ['ticker', 'name', 'country', 'exchange', 'asset_class', 'security_type']
+
+
+class SecurityMaster:
+    """Security master keyed by cusip, or by `security_key_columns` if cusip is null.
+
+    Rows are upserted with "last seen" semantics in O(new rows) using hash maps. The result is the same as
+    concatenating the rows and dropping duplicates with keep='last' after each upsert: rows with a null cusip are kept
+    in the order they were last seen.
+
+    Args:
+        columns: Columns of the security master. Must include 'cusip' and `security_key_columns`.
+    """
+
+    NULL = '\x00'  # key value of null fields.
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.by_cusip = {}
+        self.by_key = {}
+
+    def __len__(self):
+        return len(self.by_cusip) + len(self.by_key)
+
+    def upsert(self, df):
+        """Insert or update the rows of `df`. `df` should not have duplicate keys.
+        """
+        df = df[self.columns]
+        is_cusip_null = df['cusip'].isna()
+
+        df1 = df[~is_cusip_null]
+        self.by_cusip.update(zip(df1['cusip'], df1.itertuples(index=False, name=None)))
+
+        df2 = df[is_cusip_null]
+        keys = df2[security_key_columns].astype(object).fillna(self.NULL).itertuples(index=False, name=None)
+        for key, row in zip(keys, df2.itertuples(index=False, name=None)):
+            self.by_key.pop(key, None)  # Move the key to the end.
+            self.by_key[key] = row
+
+    def to_frame(self):
+        rows = list(self.by_cusip.values()) + list(self.by_key.values())
+        return pd.DataFrame(rows, columns=self.columns)
+
+
+SYNTHETIC_CUSIP_PATH = DATA_DIR + 'synthetic_cusips.pickle'
+
+
+def assign_synthetic_cusips(securities):
+    """Assign synthetic cusips, '{1000000 + n}X', to the securities whose cusip is null (in place).
+
+    Synthetic cusips are kept in a registry (SYNTHETIC_CUSIP_PATH) keyed by `security_key_columns`: a security keeps its
+    synthetic cusip across runs regardless of the input date range, and new securities get new cusips in bulk.
+
+    Args:
+        securities: Security master with 'cusip' and `security_key_columns`.
+    """
+    if os.path.exists(SYNTHETIC_CUSIP_PATH):
+        registry = pd.read_pickle(SYNTHETIC_CUSIP_PATH)
+    else:
+        registry = pd.DataFrame(columns=security_key_columns + ['cusip'], dtype=object)
+
+    is_cusip_null = securities['cusip'].isna()
+    keys = securities.loc[is_cusip_null, security_key_columns].merge(registry, on=security_key_columns, how='left')
+
+    is_new = keys['cusip'].isna().to_numpy()
+    n = len(registry) + np.arange(is_new.sum())
+    keys.loc[is_new, 'cusip'] = pd.Series(1000000 + n, index=keys.index[is_new]).astype(str) + 'X'
+    if is_new.any():
+        registry = pd.concat([registry, keys[is_new]], ignore_index=True)
+        registry.to_pickle(SYNTHETIC_CUSIP_PATH)
+
+    securities.loc[is_cusip_null, 'cusip'] = keys['cusip'].to_numpy()
+
+
+@instrumented('securities')
+def process_constituent_files1(sdate=None, edate=None, incremental=False):
+    """
+    If `incremental` is True, only the dates whose files are new or have changed since the last run are added to the
+    security master saved in data/securities_raw.pickle. If any of them is earlier than the last processed date, all
+    dates are processed. Otherwise, the security master is rebuilt from the dates between `sdate` and `edate`. If no
+    date is processed, the saved files are kept.
     """
     columns1 = [
         'cusip',
@@ -254,54 +1275,78 @@ def process_constituent_files1(sdate=None, edate=None):
         'date',
     ]
 
-    dates = get_avaiable_dates(sdate, edate)
+    dates = get_avaiable_dates(sdate, edate, 'constituents')
+    manifest = load_manifest('securities')
+    pending, signatures = get_pending_dates('constituents', dates, manifest, hash=incremental)
     securities = None
+    rebuild = True
+    if incremental:
+        if not pending:
+            log('securities: no new files.')
+            save_manifest('securities', manifest)
+            return pd.read_pickle(f'data/securities.pickle')
+
+        if is_appending(pending, manifest) and os.path.exists(f'data/securities_raw.pickle'):
+            dates = pending
+            securities = pd.read_pickle(f'data/securities_raw.pickle')
+            rebuild = False
+
+    master = SecurityMaster(columns1)
+    if securities is not None:
+        master.upsert(securities)
+
+    processed = []
+    failures = []
     for date in dates:
-        print(date)
-        try:
-            df = read_constituents_file(date)
-        except Exception as e:
-            print(e)
-            continue
-
-        df1 = df[columns1].copy()
-        df1['ticker'] = v_cleanse_ticker(df1['ticker'])
-        df1.loc[df1.ticker == '', 'ticker'] = None
-        df1['cusip'] = df1['cusip'].str[:8]
-        df1['name'] = df1['name'].str.lower()
-        log(f'Data size before dropping duplicates: {df1.shape}')
+        with span('date', date):
+            try:
+                df1 = read_constituents_file(date, columns1)
+            except Exception as e:
+                failures.append((date, f'{type(e).__name__}: {e}'))
+                continue
+
+            with span('transform', date, rows=len(df1)):
+                df1['ticker'] = cleanse_tickers(df1['ticker'])
+                df1.loc[df1.ticker == '', 'ticker'] = None
+                df1['cusip'] = df1['cusip'].str[:8]
+                df1['name'] = df1['name'].str.lower()
 # 2      2012-01-03             AMLP    SXL             sunoco logistics partners lp   0.030           NaN   NaN           NaN           NaN      NaN           NaN     NaN          NaN         NaN           NaN    NaN
-        is_cusip_null = df1['cusip'].isna()
-        df2 = df1[~is_cusip_null].drop_duplicates(['cusip'], keep='last')
-        df3 = df1[is_cusip_null].drop_duplicates(columns1[1:-1], keep='last')
-        df1 = pd.concat([df2, df3])
-        log(f'Data size after dropping duplicates: {df1.shape}')
-
-        # df2 = []
-        # for k, g in df1.groupby('cusip', dropna=False):
-        #     if (k is not None) and len(g) > 1:
-        #         if len(g['name'].unique()) > 1:
-        #             g['name'] = g['name'].sort_values().iloc[0]
-        #         n = g['ticker'].isna().sum()
-        #         if (n > 0) and (n < len(g)):
-        #             g.loc[g['ticker'].isna(), 'ticker'] = g['ticker'].sort_values().iloc[0]
-        #
-        #     df2.append(g)
-        #
-        # df1 = pd.concat(df2)
-
-        if securities is None:
-            securities = df1
-        else:
-            securities = pd.concat([securities, df1])
-        # securities = securities.groupby(['cusip', 'ticker', 'name'], as_index=False, dropna=False).last()
-        is_cusip_null = securities['cusip'].isna()
-        df2 = securities[~is_cusip_null].drop_duplicates(['cusip'], keep='last')
-        df3 = securities[is_cusip_null].drop_duplicates(columns1[1:-1], keep='last')
-        securities = pd.concat([df2, df3])
-        log(f'securities size: {securities.shape}')
-
-    securities.sort_values('cusip', inplace=True)
+            with span('dedup', date, rows_in=len(df1)) as s:
+                is_cusip_null = df1['cusip'].isna()
+                df2 = df1[~is_cusip_null].drop_duplicates(['cusip'], keep='last')
+                df3 = df1[is_cusip_null].drop_duplicates(columns1[1:-1], keep='last')
+                df1 = pd.concat([df2, df3])
+                s.set(rows=len(df1))
+
+            # df2 = []
+            # for k, g in df1.groupby('cusip', dropna=False):
+            #     if (k is not None) and len(g) > 1:
+            #         if len(g['name'].unique()) > 1:
+            #             g['name'] = g['name'].sort_values().iloc[0]
+            #         n = g['ticker'].isna().sum()
+            #         if (n > 0) and (n < len(g)):
+            #             g.loc[g['ticker'].isna(), 'ticker'] = g['ticker'].sort_values().iloc[0]
+            #
+            #     df2.append(g)
+            #
+            # df1 = pd.concat(df2)
+
+            # securities = securities.groupby(['cusip', 'ticker', 'name'], as_index=False, dropna=False).last()
+            with span('merge', date, rows_in=len(df1)) as s:
+                master.upsert(df1)
+                s.set(rows=len(master))
+            processed.append(date)
+    report_failures('securities', failures)
+    if not processed:  # failed dates stay out of the manifest and are retried in the next run.
+        update_manifest(manifest, dates, processed, signatures)
+        save_manifest('securities', manifest)
+        return pd.read_pickle(f'data/securities.pickle') if os.path.exists(f'data/securities.pickle') else None
+    if rebuild:  # the security master is rebuilt from `dates` only, so the other dates are no longer done.
+        manifest.clear()
+
+    securities = master.to_frame()
+    securities.to_pickle(f'data/securities_raw.pickle')
+    securities = securities.sort_values('cusip')
     securities = securities.drop_duplicates(columns1[1:-1], keep='first')
     # df2 = []
     # for k, g in df1.groupby(['ticker', 'name']):
@@ -318,18 +1363,116 @@ def process_constituent_files1(sdate=None, edate=None):
     securities = securities.rename(columns={'date': 'last_date'})
     securities.reset_index(drop=True, inplace=True)
     securities['null_cusip'] = securities['cusip'].isna()
-    n = 0
-    for idx in securities.index:
-        if securities.loc[idx, 'null_cusip']:
-            cusip = f'{1000000 + n}X'
-            securities.loc[idx, 'cusip'] = cusip
-            n += 1
+    assign_synthetic_cusips(securities)
 
     securities.to_pickle(f'data/securities.pickle')
+    pd.to_pickle(build_security_index(securities), SECURITY_INDEX_PATH)
+    update_manifest(manifest, dates, processed, signatures)
+    save_manifest('securities', manifest)
     return securities
 
 
-def process_constituent_files2(sdate=None, edate=None):
+holdings_columns = [
+    'date',
+    'composite_ticker',
+    'cusip',
+    'weight',
+    'market_value',
+    'shares_held'
+]
+
+SECURITY_INDEX_PATH = DATA_DIR + 'securities_index.pickle'
+
+
+def hash_security_keys(df):
+    """Compute the 64-bit hash of `security_key_columns` of each row. Null fields hash to the same value.
+    """
+    keys = df[security_key_columns].astype(object).fillna(SecurityMaster.NULL)
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def build_security_index(securities):
+    """Build the index of the security master for null-cusip resolution.
+
+    The index is a sorted array of the 64-bit hashes of `security_key_columns` with the cusips in the same order.
+    Rows can be resolved to cusips by a vectorized binary search (lookup_security_index()).
+
+    Returns:
+        Dict with 'hash', 'cusip', and 'n_duplicates', the number of hashes that appear more than once.
+    """
+    hashes = hash_security_keys(securities)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    return {
+        'hash': hashes,
+        'cusip': securities['cusip'].to_numpy(dtype=object)[order],
+        'n_duplicates': int((np.diff(hashes) == 0).sum()),
+    }
+
+
+def load_security_index():
+    if os.path.exists(SECURITY_INDEX_PATH):
+        return pd.read_pickle(SECURITY_INDEX_PATH)
+
+    index = build_security_index(pd.read_pickle('data/securities.pickle'))
+    pd.to_pickle(index, SECURITY_INDEX_PATH)
+    return index
+
+
+def lookup_security_index(index, df):
+    """Resolve the rows of `df` to cusips using the security index.
+
+    Returns:
+        cusip, found, ambiguous: Ndarrays aligned with `df`. cusip is None if not found. ambiguous is True if the key
+        hash appears more than once in the index, in which case the first match is used.
+    """
+    hashes = hash_security_keys(df)
+    n = len(index['hash'])
+    if n == 0:
+        return np.full(len(df), None, dtype=object), np.zeros(len(df), bool), np.zeros(len(df), bool)
+
+    pos = np.minimum(np.searchsorted(index['hash'], hashes), n - 1)
+    found = index['hash'][pos] == hashes
+    cusip = np.where(found, index['cusip'][pos], None)
+    nxt = np.minimum(pos + 1, n - 1)
+    ambiguous = found & (nxt != pos) & (index['hash'][nxt] == hashes)
+    return cusip, found, ambiguous
+
+
+_security_index = None  # security index used by _process_constituent_file2()
+
+
+def _set_security_index(index):
+    global _security_index
+    _security_index = index
+
+
+def _process_constituent_file2(date):
+    df = read_constituents_file(date, holdings_columns + security_key_columns)
+
+    with span('transform', date, rows=len(df)):
+        df['ticker'] = cleanse_tickers(df['ticker'])
+        df.loc[df.ticker == '', 'ticker'] = None
+        df['cusip'] = df['cusip'].str[:8]
+        df['name'] = df['name'].str.lower()
+
+    with span('merge', date) as s:
+        is_cusip_null = df['cusip'].isna()
+        df1 = df[is_cusip_null].copy()
+        df1['cusip'], found, ambiguous = lookup_security_index(_security_index, df1)
+        s.set(rows=len(df1))
+
+    df2 = pd.concat([df.loc[~is_cusip_null, holdings_columns], df1[holdings_columns]])
+    diagnostics = {
+        'null_cusip_rows': len(df1),
+        'ambiguous_rows': int(ambiguous.sum()),
+        'unresolved_rows': int((~found).sum()),
+    }
+    return df2, diagnostics
+
+
+@instrumented('holdings')
+def process_constituent_files2(sdate=None, edate=None, n_jobs=1, incremental=False):
     """
     columns =
         'etfg_date',  # missing in old files
@@ -350,64 +1493,345 @@ def process_constituent_files2(sdate=None, edate=None):
         'Security_Type',  # 14, 15
         'Currency_Traded'  # missing in old files
 
+    If `incremental` is True, only the dates whose files are new or have changed since the last run are processed, and
+    only the partitions containing them are rewritten. Otherwise, if `sdate` or `edate` is given, the rows of the dates
+    in the range are replaced and the other dates are kept, and if neither is given, the dataset is rebuilt.
+
     :return:
     """
-    columns2 = [
-        'date',
-        'composite_ticker',
-        'cusip',
-        'weight',
-        'market_value',
-        'shares_held'
-    ]
+    dates = get_avaiable_dates(sdate, edate, 'constituents')
+    manifest = load_manifest('holdings')
+    pending, signatures = get_pending_dates('constituents', dates, manifest, hash=incremental)
+    if incremental:
+        dates = pending
+        if not dates:
+            log('holdings: no new files.')
+            save_manifest('holdings', manifest)
+            return
+
+    rebuild = not (incremental or sdate or edate)
+    index = load_security_index()
+    # Partitions are merged unless all their dates are processed, i.e., the dataset is rebuilt.
+    writer = PartitionWriter('holdings', ['composite_ticker', 'date'], update=not rebuild)
+    processed = []
+    failures = []
+    diagnostics = {'security_index_duplicates': index['n_duplicates']}
+    for date, result, error in map_dates(_process_constituent_file2, dates, n_jobs, _set_security_index, (index,)):
+        if error:
+            failures.append((date, error))
+            continue
 
-    dates = get_avaiable_dates(sdate, edate)
-    securities = pd.read_pickle('data/securities.pickle')
-    securities.rename(columns={'cusip': 'cusip2'}, inplace=True)
-    holdings = []
-    for date in dates:
-        print(date)
-        # if date[:4] != year:
-        #     holdings = pd.concat(holdings)
-        #     holdings['date'] = pd.to_datetime(holdings['date'])
-        #     holdings = holdings.sort_values(['composite_ticker', 'date'])
-        #     holdings.to_pickle(f'data/holdings_{year}.pickle')
-        #     holdings = []
-        #     year = date[:4]
+        df, counts = result
+        for key, count in counts.items():
+            diagnostics[key] = diagnostics.get(key, 0) + count
+        writer.add(date, df)
+        processed.append(date)
+    writer.flush()
+    report_failures('holdings', failures)
+    emit_event('diagnostics', **diagnostics)
+    log(f'holdings: {diagnostics}')
 
-        try:
-            df = read_constituents_file(date)
-        except Exception as e:
-            print(e)
-            continue
+    if rebuild and processed:
+        prune_partitions('holdings', dates)
+        manifest.clear()  # the dates whose files are gone are no longer in the dataset.
+    update_manifest(manifest, dates, processed, signatures)
+    save_manifest('holdings', manifest)
 
-        df['ticker'] = v_cleanse_ticker(df['ticker'])
-        df.loc[df.ticker == '', 'ticker'] = None
-        df['cusip'] = df['cusip'].str[:8]
-        df['name'] = df['name'].str.lower()
 
-        is_cusip_null = df['cusip'].isna()
-        df1 = df[is_cusip_null]
-        l1 = len(df1)
-        df1 = df1.merge(securities[['cusip2', 'ticker', 'name', 'country', 'exchange', 'asset_class', 'security_type']],
-                      on=['ticker', 'name', 'country', 'exchange', 'asset_class', 'security_type'], how='left')
-        if l1 != len(df1):
-            print(l1, len(df1))
-
-        df1['cusip'] = df1['cusip2']
-        df2 = pd.concat([df.loc[~is_cusip_null, columns2], df1[columns2]])
-        print('null cusip: ', df2.cusip.isna().sum())
-        holdings.append(df2)
-
-    holdings = pd.concat(holdings)
-    holdings['date'] = pd.to_datetime(holdings['date'])
-    holdings = holdings.sort_values(['composite_ticker', 'date'])
-    holdings.to_pickle(f'data/holdings.pickle')
-
-
-def create_name_map():
-    wrds = WRDS('fehouse')
-    stocknames = wrds.read_data('stocknames')
+CRSP_DIR = DATA_DIR + 'crsp/'  # local snapshots of CRSP tables.
+CRSP_MAX_AGE_DAYS = 30  # snapshots older than this are refreshed when refresh='auto'.
+OFFLINE = os.environ.get('ETFG_OFFLINE', '0') == '1'  # If True, never connect to WRDS.
+
+
+def get_crsp_table_info(name):
+    """Get the version stamp of the local snapshot of a CRSP table: {'name', 'source', 'version', 'saved_at', 'rows'}.
+    None if there is no snapshot.
+    """
+    path = CRSP_DIR + f'{name}.json'
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_crsp_table(name, df, source='wrds'):
+    """Save `df` as the local snapshot of a CRSP table.
+
+    This can also be used to supply a stand-in table, e.g., in tests or on a machine without WRDS access.
+
+    Args:
+        name: Table name, e.g., 'stocknames'.
+        df: Table.
+        source: Where the table came from. Saved in the version stamp.
+    """
+    os.makedirs(CRSP_DIR, exist_ok=True)
+    df.to_parquet(CRSP_DIR + f'.{name}.parquet', index=False)
+    os.replace(CRSP_DIR + f'.{name}.parquet', CRSP_DIR + f'{name}.parquet')
+
+    info = get_crsp_table_info(name)
+    info = {
+        'name': name,
+        'source': source,
+        'version': (info['version'] + 1) if info else 1,
+        'saved_at': time.time(),
+        'rows': len(df),
+    }
+    with open(CRSP_DIR + f'{name}.json', 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+def read_crsp_table(name, refresh='auto', offline=None):
+    """Read a CRSP table from its local snapshot, downloading it from WRDS if needed.
+
+    Args:
+        name: Table name, e.g., 'stocknames'.
+        refresh: Refresh policy. 'auto': download if there is no snapshot or it is older than CRSP_MAX_AGE_DAYS.
+            'always': always download. 'never': never download.
+        offline: If True, never connect to WRDS and raise an error if there is no snapshot. Default to OFFLINE.
+
+    Returns:
+        DataFrame.
+    """
+    offline = OFFLINE if offline is None else offline
+    info = get_crsp_table_info(name)
+    if info is None:
+        stale = True
+    elif refresh == 'always':
+        stale = True
+    elif refresh == 'auto':
+        stale = time.time() - info['saved_at'] > CRSP_MAX_AGE_DAYS * 86400
+    else:
+        stale = False
+
+    if stale and not offline and refresh != 'never':
+        wrds = WRDS('fehouse')
+        df = wrds.read_data(name)
+        save_crsp_table(name, df)
+        return df
+
+    if info is None:
+        raise FileNotFoundError(f'There is no local snapshot of {name}. Download it online or use save_crsp_table().')
+
+    if stale:
+        log(f'{name}: using a snapshot older than {CRSP_MAX_AGE_DAYS} days (version {info["version"]}).')
+    return pd.read_parquet(CRSP_DIR + f'{name}.parquet')
+
+
+def _char_ngrams(name, n):
+    name = f' {name} '
+    return [name[i:i + n] for i in range(len(name) - n + 1)]
+
+
+def ngram_matrix(names, vocabulary, idf=None, n=3):
+    """Build the L2-normalized character n-gram matrix of names.
+
+    Args:
+        names: List of names.
+        vocabulary: Dict of {n-gram: column}. N-grams not in `vocabulary` are ignored.
+        idf: Ndarray of n-gram weights. If None, n-grams are weighted equally.
+        n: N-gram size.
+
+    Returns:
+        CSR matrix of shape (len(names), len(vocabulary)).
+    """
+    indptr = [0]
+    indices = []
+    for name in names:
+        indices += [vocabulary[gram] for gram in _char_ngrams(name, n) if gram in vocabulary]
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.float32)
+    X = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(names), len(vocabulary)))
+    X.sum_duplicates()
+    if idf is not None:
+        X = X @ scipy.sparse.diags(idf.astype(np.float32))
+
+    norm = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norm[norm == 0] = 1
+    return scipy.sparse.diags(1 / norm) @ X
+
+
+_name_index = None  # (candidate n-gram matrix transposed, candidates) used by _match_names()
+
+
+def _set_name_index(CT, candidates):
+    global _name_index
+    _name_index = (CT, candidates)
+
+
+def _match_names(args):
+    Q, names, k, cutoff = args
+    CT, candidates = _name_index
+    S = (Q @ CT).toarray()
+    k = min(k, S.shape[1])
+    top = np.argpartition(-S, k - 1, axis=1)[:, :k]
+
+    matches = []
+    for name, idx, sims in zip(names, top, np.take_along_axis(S, top, axis=1)):
+        for j, sim in zip(idx, sims):
+            if sim <= 0:  # no common n-gram
+                continue
+            ratio = SequenceMatcher(None, candidates[j], name).ratio()  # same as difflib.get_close_matches()
+            if ratio >= cutoff:
+                matches.append((name, candidates[j], sim, ratio))
+
+    return matches
+
+
+def match_names(names, candidates, k=10, cutoff=0.7, n=3, n_jobs=1, chunk_size=256):
+    """Find the closest candidates of each name.
+
+    Candidates are indexed by their tf-idf weighted character n-grams. For each name, only the candidates sharing
+    n-grams with it are considered (blocking), and the top `k` candidates by cosine similarity are found with sparse
+    matrix products. These are then scored by SequenceMatcher ratio as in difflib.get_close_matches(), and those with
+    ratio >= `cutoff` are kept. Names are processed in chunks, optionally across `n_jobs` processes.
+
+    Args:
+        names: List of names to match.
+        candidates: List of candidate names.
+        k: Number of candidates per name to score.
+        cutoff: Minimum ratio.
+        n: N-gram size.
+        n_jobs: Number of worker processes.
+        chunk_size: Number of names per chunk.
+
+    Returns:
+        DataFrame with columns name, candidate, cosine, and ratio, sorted by name and descending ratio.
+    """
+    names = list(names)
+    candidates = list(candidates)
+
+    vocabulary = {}
+    for candidate in candidates:
+        for gram in _char_ngrams(candidate, n):
+            vocabulary.setdefault(gram, len(vocabulary))
+    doc_freq = np.bincount(ngram_matrix(candidates, vocabulary, n=n).indices, minlength=len(vocabulary))
+    idf = np.log((1 + len(candidates)) / (1 + doc_freq)) + 1
+
+    CT = ngram_matrix(candidates, vocabulary, idf, n).T.tocsr()
+    Q = ngram_matrix(names, vocabulary, idf, n).tocsr()
+    tasks = [(Q[i:i + chunk_size], names[i:i + chunk_size], k, cutoff) for i in range(0, len(names), chunk_size)]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs, initializer=_set_name_index, initargs=(CT, candidates)) as executor:
+            results = list(executor.map(_match_names, tasks))
+    else:
+        _set_name_index(CT, candidates)
+        results = [_match_names(task) for task in tasks]
+
+    matches = pd.DataFrame([m for result in results for m in result], columns=['name', 'candidate', 'cosine', 'ratio'])
+    # Ties are broken by the larger candidate as in difflib.get_close_matches().
+    return matches.sort_values(['name', 'ratio', 'candidate'], ascending=[True, False, False], ignore_index=True)
+
+
+def check_name_match_recall(names, candidates, n=200, cutoff=0.7, seed=0, **kwargs):
+    """Check the recall of match_names() against difflib.get_close_matches() on a sample of `names`.
+
+    Recall is the fraction of the names matched by difflib for which match_names() finds the same best match.
+
+    Args:
+        names: List of names to match.
+        candidates: List of candidate names.
+        n: Sample size.
+        cutoff: Minimum ratio.
+        seed: Random seed.
+        kwargs: Other arguments of match_names().
+
+    Returns:
+        Recall.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(rng.choice(np.array(names, dtype=object), min(n, len(names)), replace=False))
+
+    expected = {}
+    for name in names:
+        ret = difflib.get_close_matches(name, candidates, n=1, cutoff=cutoff)
+        if ret:
+            expected[name] = ret[0]
+
+    matches = match_names(names, candidates, cutoff=cutoff, **kwargs)
+    best = matches.drop_duplicates('name').set_index('name')['candidate']
+    hits = sum(best.get(name) == crsp_name for name, crsp_name in expected.items())
+    recall = hits / len(expected) if expected else 1.0
+    log(f'name match recall: {hits}/{len(expected)} = {recall:.3f}')
+    return recall
+
+
+def _sequence_ratios(pairs):
+    return [(SequenceMatcher(None, a, b).ratio(), SequenceMatcher(None, b, a).ratio()) for a, b in pairs]
+
+
+def _token_matrix(names, vocabulary):
+    indptr = [0]
+    indices = []
+    for name in names:
+        indices += [vocabulary.setdefault(token, len(vocabulary)) for token in set(name.split())]
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.float32)
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(names), len(vocabulary)))
+
+
+def score_name_pairs(names1, names2, n_jobs=1, chunk_size=10000):
+    """Compute the similarity metrics of name pairs.
+
+    Duplicate pairs are scored once. SequenceMatcher ratios are computed in chunks, optionally across `n_jobs`
+    processes, and the token-based metrics are computed for all pairs at once with sparse matrices.
+
+    Args:
+        names1: List of names.
+        names2: List of names to compare with `names1`.
+        n_jobs: Number of worker processes.
+        chunk_size: Number of pairs per chunk.
+
+    Returns:
+        DataFrame with the following columns, aligned with the inputs.
+
+            * match1: SequenceMatcher(None, name1, name2).ratio()
+            * match2: SequenceMatcher(None, name2, name1).ratio()
+            * token_jaccard: Jaccard similarity of the word sets.
+            * ngram_cosine: Cosine similarity of the character trigram counts.
+    """
+    pairs = pd.MultiIndex.from_arrays([list(names1), list(names2)])
+    codes, pairs = pd.factorize(pairs)
+    pairs = list(pairs)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            ratios = list(executor.map(_sequence_ratios, chunks))
+    else:
+        ratios = [_sequence_ratios(chunk) for chunk in chunks]
+    ratios = np.array([r for chunk in ratios for r in chunk], dtype=float).reshape(-1, 2)
+
+    a = [pair[0] for pair in pairs]
+    b = [pair[1] for pair in pairs]
+    vocabulary = {}
+    A = _token_matrix(a, vocabulary)
+    B = _token_matrix(b, vocabulary)
+    A.resize(len(a), len(vocabulary))
+    intersection = np.asarray(A.multiply(B).sum(axis=1)).ravel()
+    union = np.asarray(A.sum(axis=1)).ravel() + np.asarray(B.sum(axis=1)).ravel() - intersection
+    jaccard = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    vocabulary = {}
+    for name in a + b:
+        for gram in _char_ngrams(name, 3):
+            vocabulary.setdefault(gram, len(vocabulary))
+    cosine = np.asarray(ngram_matrix(a, vocabulary).multiply(ngram_matrix(b, vocabulary)).sum(axis=1)).ravel()
+
+    scores = pd.DataFrame({
+        'match1': ratios[:, 0],
+        'match2': ratios[:, 1],
+        'token_jaccard': jaccard,
+        'ngram_cosine': cosine,
+    })
+    return scores.iloc[codes].reset_index(drop=True)
+
+
+def create_name_map(n_jobs=1):
+    stocknames = read_crsp_table('stocknames')
     with open("etfg_names.json", 'r') as f:
         etfg_names = json.load(f)
 
@@ -416,35 +1840,142 @@ def create_name_map():
     names2 = pd.Series(crsp_names, name='name').sort_values()
     names = pd.merge(names1, names2, on='name', how='inner')
     names = list(np.squeeze(names.values))
-    etfg_names = [name for name in etfg_names if name not in names]
+    exact_names = set(names)
+    etfg_names = [name for name in etfg_names if name not in exact_names]
 
     name_mapping = {name: name for name in names}
-    for i, name in enumerate(etfg_names):
-        try:
-            ret = difflib.get_close_matches(name, crsp_names, n=1, cutoff=0.7)
-            if ret:
-                name_mapping[name] = ret[0]
-                log(f'{i}/{len(etfg_names)}: {name} - {ret[0]}')
-        except Exception as e:
-            log(e)
+    matches = match_names(etfg_names, crsp_names, k=10, cutoff=0.7, n_jobs=n_jobs)
+    matches = matches.drop_duplicates('name')
+    name_mapping.update(zip(matches['name'], matches['candidate']))
+    log(f'{len(matches)}/{len(etfg_names)} names matched.')
 
     name_mapping = pd.Series(name_mapping)
     name_mapping.index.name = 'etfg_name'
     name_mapping = name_mapping.to_frame(name='crsp_name').reset_index()
-    name_mapping['match1'] = np.nan
-    name_mapping['match2'] = np.nan
+    scores = score_name_pairs(name_mapping['etfg_name'], name_mapping['crsp_name'], n_jobs=n_jobs)
+    name_mapping['match1'] = scores['match1'].to_numpy()
+    name_mapping['match2'] = scores['match2'].to_numpy()
     name_mapping['etfg_name2'] = name_mapping['etfg_name'].str[:10]
     name_mapping['crsp_name2'] = name_mapping['crsp_name'].str[:10]
-    for i in name_mapping.index:
-        print(f"{i}/{len(name_mapping)}: {name_mapping.loc[i, 'etfg_name']}")
-        name_mapping.loc[i, 'match1'] = SequenceMatcher(None, name_mapping.loc[i, 'etfg_name'], name_mapping.loc[i, 'crsp_name']).ratio()
-        name_mapping.loc[i, 'match2'] = SequenceMatcher(None, name_mapping.loc[i, 'crsp_name'], name_mapping.loc[i, 'etfg_name']).ratio()
-        name_mapping.loc[i, 'match3'] = SequenceMatcher(None, name_mapping.loc[i, 'crsp_name'], name_mapping.loc[i, 'etfg_name']).ratio()
+    name_mapping['match3'] = scores['match2'].to_numpy()
+    name_mapping['token_jaccard'] = scores['token_jaccard'].to_numpy()
+    name_mapping['ngram_cosine'] = scores['ngram_cosine'].to_numpy()
 
     name_mapping.to_pickle('data/name_mapping.pickle')
 
 
-def link_etfg_permno():
+link_passes = ['cusip', 'ncusip', 'ticker', 'name']
+
+
+def build_permno_links(stocknames, name_mapping=None):
+    """Build the lookup tables of link_permno() from CRSP stocknames.
+
+    Args:
+        stocknames: CRSP stocknames with permno, cusip, ncusip, ticker, comnam, namedt, and nameenddt.
+        name_mapping: ETFG name to CRSP name mapping generated by create_name_map(). If None, the name pass is skipped.
+
+    Returns:
+        Dict of {pass: lookup}. Lookups of 'cusip' and 'ncusip' are Series of permno indexed by (n)cusip, and those of
+        'ticker' and 'name' are (key, namedt, nameenddt, permno) intervals sorted by namedt.
+    """
+    stocknames = stocknames.copy()
+    stocknames['namedt'] = pd.to_datetime(stocknames['namedt']).astype('datetime64[ns]')
+    stocknames['nameenddt'] = pd.to_datetime(stocknames['nameenddt']).astype('datetime64[ns]')
+    stocknames = stocknames.sort_values('namedt')
+
+    links = {}
+    for col in ['cusip', 'ncusip']:
+        link = stocknames[[col, 'permno']].dropna().drop_duplicates(col, keep='last')
+        links[col] = link.set_index(col)['permno']
+
+    ticker = stocknames[['ticker', 'namedt', 'nameenddt', 'permno']].dropna(subset=['ticker']).drop_duplicates()
+    links['ticker'] = ticker.reset_index(drop=True)
+
+    if name_mapping is not None:
+        name = stocknames[['comnam', 'namedt', 'nameenddt', 'permno']].copy()
+        name['crsp_name'] = name.pop('comnam').str.lower()
+        name = name.merge(name_mapping[['etfg_name', 'crsp_name']], on='crsp_name')
+        name = name.rename(columns={'etfg_name': 'name'}).drop(columns='crsp_name').drop_duplicates()
+        links['name'] = name.sort_values('namedt', ignore_index=True)
+
+    return links
+
+
+def _link_asof(keys, intervals, key):
+    """Find the permno whose [namedt, nameenddt] interval of `key` contains the date of each row of `keys`.
+
+    Intervals are searched by a sorted as-of merge per key value, so the key-date cross product is not materialized.
+    """
+    left = pd.DataFrame({
+        'row': np.arange(len(keys)),
+        key: keys[key].to_numpy(),
+        'date': pd.to_datetime(keys['date']).to_numpy(dtype='datetime64[ns]'),
+    })
+    left = left.sort_values('date')
+    merged = pd.merge_asof(left, intervals, left_on='date', right_on='namedt', by=key, direction='backward')
+    merged.loc[merged['date'] > merged['nameenddt'], 'permno'] = np.nan
+    return merged.sort_values('row')['permno'].to_numpy()
+
+
+def link_permno(df, links):
+    """Link securities to PERMNO.
+
+    Rows are linked in passes: cusip to CRSP cusip, cusip to CRSP ncusip, (ticker, date) to the CRSP ticker valid on
+    the date, and (name, date) to the CRSP company name valid on the date. Each pass only considers the rows not
+    linked by the previous passes.
+
+    Args:
+        df: DataFrame with cusip, ticker, name, and date.
+        links: Lookup tables generated by build_permno_links().
+
+    Returns:
+        permno, link_pass: Ndarrays aligned with `df`. link_pass is the pass that linked the row or None.
+    """
+    permno = np.full(len(df), np.nan)
+    link_pass = np.full(len(df), None, dtype=object)
+
+    for p in link_passes:
+        if p not in links:
+            continue
+
+        key = 'cusip' if p in ('cusip', 'ncusip') else p
+        todo = np.isnan(permno) & df[key].notna().to_numpy()
+        if not todo.any():
+            continue
+
+        if p in ('cusip', 'ncusip'):
+            found = df.loc[todo, key].map(links[p]).to_numpy(dtype=float)
+        else:
+            found = _link_asof(df[todo], links[p], key)
+
+        permno[todo] = found
+        link_pass[todo & ~np.isnan(permno)] = p
+
+    return permno, link_pass
+
+
+def count_link_passes(link_pass, market_value=None):
+    """Count the rows and market value linked by each pass. Unlinked rows are counted as 'none'.
+    """
+    counts = pd.DataFrame({
+        'pass': pd.Series(link_pass, dtype=object).fillna('none').to_numpy(),
+        'rows': 1,
+        'market_value': 0 if market_value is None else np.nan_to_num(np.asarray(market_value, dtype=float)),
+    })
+    return counts.groupby('pass')[['rows', 'market_value']].sum().reindex(link_passes + ['none'], fill_value=0)
+
+
+def report_link_rates(name, counts):
+    """Log and return the link rates by pass, in terms of rows and market value.
+    """
+    rates = counts / counts.sum().replace(0, np.nan)
+    for p, row in rates.iterrows():
+        log(f'{name} link rate ({p}): rows {row["rows"]:.4f}, market value {row["market_value"]:.4f}')
+    return rates
+
+
+@instrumented('link')
+def link_etfg_permno(max_memory_mb=1024):
     """
     TICKER
 The combination of ticker, exchange, and date uniquely identifies a security. A ticker may be one to three characters for NYSE and AMEX securities or four or five characters for Nasdaq securities. Nasdaq trading tickers have four base characters and a fifth character suffix that provides information about an issue's type or temporary information about an issue's status. CRSP only includes the suffix when it provides permanent descriptive information. This table describes the suffixes appearing on the CRSP file.
@@ -482,16 +2013,15 @@ A CUSIP such as 12399099 or 12345699 is assigned by CRSP, and an identifier such
 
 
     """
-    wrds = WRDS('fehouse')
-    stocknames = wrds.read_data('stocknames')
-
-    cusip = stocknames[['permno', 'cusip']].drop_duplicates()
-    ncusip = stocknames[['permno', 'ncusip']].drop_duplicates().rename(columns={'ncusip': 'cusip'})
-    cusip = pd.concat([cusip, ncusip]).drop_duplicates().dropna()
+    stocknames = read_crsp_table('stocknames')
+    name_mapping = pd.read_pickle('./data/name_mapping.pickle') if os.path.exists('./data/name_mapping.pickle') else None
+    links = build_permno_links(stocknames, name_mapping)
 
     sec = pd.read_pickle('./data/securities.pickle')
-    sec = sec.merge(cusip, on='cusip', how='left')
+    sec = sec.drop(columns=['permno', 'link_pass'], errors='ignore')
+    sec['permno'], sec['link_pass'] = link_permno(sec.rename(columns={'last_date': 'date'}), links)
     sec.to_pickle('./data/securities.pickle')
+    report_link_rates('securities', count_link_passes(sec['link_pass']))
 
     # securities.rename(columns={'permno': 'permno1'})
     # # holdings_mapped = holdings[~holdings['permno'].isna()]
@@ -505,12 +2035,746 @@ A CUSIP such as 12399099 or 12345699 is assigned by CRSP, and an identifier such
     #
     # securities = securities[securities['permno'].isna()]
 
-    years = [2017, 2018, 2019, 2020, 2021]
-    for year in years:
-        fpath = f'./data/holdings_{year}.pickle'
-        holdings = pd.read_pickle(fpath)
-        holdings = holdings.merge(cusip, on='cusip', how='left')
-        holdings.to_pickle(fpath)
+    ids = sec.drop_duplicates('cusip').set_index('cusip')[['ticker', 'name']]
+    counts = count_link_passes([])
+    for year, month in list_partitions('holdings'):
+        path = get_partition_dir('holdings', year, month) + 'part-0.parquet'
+        counts += link_holdings_file(path, links, ids, max_memory_mb)
+
+    return report_link_rates('holdings', counts)
+
+
+LINK_MEMORY_FACTOR = 8  # in-memory size of a holdings row during linking relative to its uncompressed parquet size.
+
+
+def link_holdings_file(path, links, ids, max_memory_mb=1024):
+    """Attach permno to a holdings parquet file in bounded-size batches.
+
+    The file is streamed in batches whose size is derived from `max_memory_mb`. Each batch is linked against the
+    lookup tables and appended to a temporary file, which replaces the original file at the end. Peak memory is about
+    `max_memory_mb` plus the lookup tables, regardless of the file size.
+
+    Args:
+        path: Holdings file path.
+        links: Lookup tables generated by build_permno_links().
+        ids: DataFrame of ticker and name indexed by cusip.
+        max_memory_mb: Memory budget of a batch in MB.
+
+    Returns:
+        Counts of the rows and market value linked by each pass. See count_link_passes().
+    """
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+    counts = count_link_passes([])
+    with open(path, 'rb') as f:
+        file = pyarrow.parquet.ParquetFile(f)
+        meta = file.metadata
+        file_bytes = sum(meta.row_group(i).total_byte_size for i in range(meta.num_row_groups))
+        bytes_per_row = LINK_MEMORY_FACTOR * max(file_bytes / max(meta.num_rows, 1), 1)
+        batch_rows = max(int(max_memory_mb * 2 ** 20 / bytes_per_row), 1000)
+
+        columns = [col for col in file.schema_arrow.names if col != 'permno']
+        schema = pyarrow.schema([file.schema_arrow.field(col) for col in columns] + [('permno', pyarrow.int32())])
+        with pyarrow.parquet.ParquetWriter(tmp_path, schema) as writer:
+            for batch in file.iter_batches(batch_size=batch_rows, columns=columns):
+                holdings = batch.to_pandas()
+                permno, link_pass = _link_holdings(holdings, links, ids)
+                holdings['permno'] = pd.array(permno, dtype=compact_dtypes['permno'])
+                writer.write_table(pyarrow.Table.from_pandas(holdings, schema=schema, preserve_index=False),
+                                   row_group_size=ROW_GROUP_SIZE)
+                counts += count_link_passes(link_pass, holdings['market_value'])
+
+    os.replace(tmp_path, path)
+    return counts
+
+
+def _link_holdings(holdings, links, ids):
+    idx = ids.index.get_indexer(holdings['cusip'])  # hash lookup of the security master; -1 if not found.
+    found = idx >= 0
+    keys = pd.DataFrame({
+        'cusip': holdings['cusip'].to_numpy(),
+        'ticker': np.where(found, ids['ticker'].to_numpy()[idx], None),
+        'name': np.where(found, ids['name'].to_numpy()[idx], None),
+        'date': holdings['date'].to_numpy(),
+    })
+    return link_permno(keys, links)
+
+
+OWNERSHIP_DIR = DATA_DIR + 'ownership/'  # cache of the ownership matrices.
+ownership_values = ['weight', 'shares_held', 'market_value']
+
+
+def _ownership_path(value, date):
+    return OWNERSHIP_DIR + f'{value}/{pd.Timestamp(date):%Y%m%d}.npz'
+
+
+def _ownership_stamp_path(year, month):
+    return OWNERSHIP_DIR + f'stamps/{year}-{month:02d}.json'
+
+
+def _save_npz_atomic(path, save, *args, **kwargs):
+    """Save with `save` (scipy.sparse.save_npz or np.savez) to a temporary file and move it to `path`, so that readers
+    never see a partially written file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.getpid()}.' + os.path.basename(path))
+    save(tmp_path, *args, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def build_ownership_matrices(year, month):
+    """Build and cache the ownership matrices of the dates in a holdings partition.
+
+    For each date and each of `ownership_values`, a sparse CSR matrix of ETFs x securities is saved in OWNERSHIP_DIR.
+    Rows and columns are the codes of the shared 'etf' and 'security' dictionaries. The security-permno links of the
+    date are saved together if holdings have been linked to permno. Cached files of the partition that are not rebuilt,
+    i.e., of dates no longer in the partition or links of a partition no longer linked, are removed. A build stamp with
+    the mtime of the partition is saved at the end, and the matrices of the partition are up to date while the stamp
+    matches the partition.
+    """
+    source = get_partition_dir('holdings', year, month) + 'part-0.parquet'
+    mtime = os.path.getmtime(source)
+    holdings = read_partition('holdings', year, month)
+    shape = (len(get_dictionary('etf')), len(get_dictionary('security')))
+    saved = set()
+    for date, g in holdings.groupby('date'):
+        etf = g['composite_ticker'].cat.codes.to_numpy()
+        security = g['cusip'].cat.codes.to_numpy()
+        valid = (etf >= 0) & (security >= 0)
+
+        for value in ownership_values:
+            data = np.nan_to_num(g[value].to_numpy(dtype=float)[valid])
+            M = scipy.sparse.coo_matrix((data, (etf[valid], security[valid])), shape=shape).tocsr()  # sums duplicates
+            _save_npz_atomic(_ownership_path(value, date), scipy.sparse.save_npz, M)
+            saved.add(_ownership_path(value, date))
+
+        if 'permno' in g:
+            permno = g['permno'].to_numpy(dtype=float, na_value=np.nan)
+            links = pd.DataFrame({'security': security, 'permno': permno})
+            links = links[valid].dropna().drop_duplicates('security')
+            _save_npz_atomic(_ownership_path('permno', date), np.savez, security=links['security'].to_numpy(),
+                             permno=links['permno'].to_numpy(dtype=np.int64))
+            saved.add(_ownership_path('permno', date))
+
+    for value in ownership_values + ['permno']:
+        dir = OWNERSHIP_DIR + value + '/'
+        if not os.path.isdir(dir):
+            continue
+        for name in os.listdir(dir):
+            if name.startswith(f'{year}{month:02d}') and (dir + name not in saved):
+                os.remove(dir + name)
+
+    stamp_path = _ownership_stamp_path(year, month)
+    os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+    with open(stamp_path + '.tmp', 'w') as f:
+        json.dump({'mtime': mtime, 'dates': list(pd.DatetimeIndex(holdings['date'].unique()).strftime('%Y-%m-%d'))}, f)
+    os.replace(stamp_path + '.tmp', stamp_path)
+
+
+def _is_ownership_stale(date):
+    """Check whether the matrices of the partition of `date` need to be (re)built: the partition exists and has been
+    modified since it was built. Dates without holdings in a built partition are not stale.
+    """
+    source = get_partition_dir('holdings', date.year, date.month) + 'part-0.parquet'
+    if not os.path.exists(source):
+        return False
+
+    stamp_path = _ownership_stamp_path(date.year, date.month)
+    if not os.path.exists(stamp_path):
+        return True
+    with open(stamp_path, 'r') as f:
+        return json.load(f)['mtime'] != os.path.getmtime(source)
+
+
+def get_ownership_matrix(date, value='shares_held'):
+    """Get the sparse ETF x security ownership matrix of a date.
+
+    The matrix is loaded from the cache, which is (re)built from the holdings partition of the date if the partition
+    has not been built since it was last modified.
+
+    Args:
+        date: Date.
+        value: One of `ownership_values`.
+
+    Returns:
+        CSR matrix of shape (len(get_dictionary('etf')), len(get_dictionary('security'))).
+    """
+    date = pd.Timestamp(date)
+    path = _ownership_path(value, date)
+    if _is_ownership_stale(date):
+        build_ownership_matrices(date.year, date.month)
+    if not os.path.exists(path):
+        raise KeyError(f'There are no holdings on {date:%Y-%m-%d}.')
+
+    M = scipy.sparse.load_npz(path).tocsr()
+    M.resize((len(get_dictionary('etf')), len(get_dictionary('security'))))  # dictionaries may have grown.
+    return M
+
+
+def ownership_by_permno(date, value='shares_held'):
+    """Total ETF ownership of each permno on a date: 1' M S, where M is the ownership matrix and S maps securities to
+    permnos.
+
+    Returns:
+        Series indexed by permno.
+    """
+    M = get_ownership_matrix(date, value)
+    by_security = np.asarray(M.sum(axis=0)).ravel()
+
+    links = np.load(_ownership_path('permno', date))
+    permnos, col = np.unique(links['permno'], return_inverse=True)
+    S = scipy.sparse.csr_matrix((np.ones(len(col)), (links['security'], col)), shape=(M.shape[1], len(permnos)))
+    return pd.Series(S.T @ by_security, index=pd.Index(permnos, name='permno'), name=value)
+
+
+def ownership_by_etf(date, value='market_value', linked=False):
+    """Total holdings of each ETF on a date: M 1, or M x if `linked` is True, where x indicates the securities linked
+    to permno.
+
+    Returns:
+        Series indexed by ETF ticker. ETFs without holdings on the date are excluded.
+    """
+    M = get_ownership_matrix(date, value)
+    x = np.ones(M.shape[1])
+    if linked:
+        x = np.zeros(M.shape[1])
+        x[np.load(_ownership_path('permno', date))['security']] = 1
+
+    total = M @ x
+    etfs = np.flatnonzero(np.diff(M.indptr))  # rows with holdings
+    return pd.Series(total[etfs], index=pd.Index(get_dictionary('etf')[etfs], name='composite_ticker'), name=value)
+
+
+_weight_dates = {}  # {flow date: holdings date}; set in each worker by _set_flow_inputs().
+_flows = {}  # {flow date: (etf codes, fund flows)}; set in each worker by _set_flow_inputs().
+
+
+def _set_flow_inputs(weight_dates, flows):
+    global _weight_dates, _flows
+    _weight_dates = weight_dates
+    _flows = flows
+
+
+def _load_flows(dates):
+    """Fund flows of `dates` as {date: (etf codes, fund flows)}. Each partition of the 'fundflow' dataset is read once.
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    partitions = set(zip(dates.dt.year, dates.dt.month)) & set(list_partitions('fundflow'))
+    flows = {}
+    for year, month in sorted(partitions):
+        df = read_partition('fundflow', year, month, ['date', 'ticker', 'fundflow'])
+        df = df[df['date'].isin(dates)]
+        for date, g in df.groupby('date'):
+            flows[date.strftime('%Y-%m-%d')] = (g['ticker'].cat.codes.to_numpy(), g['fundflow'].to_numpy(dtype=float))
+    return flows
+
+
+def _compute_flow_demand(date):
+    W = get_ownership_matrix(_weight_dates[date], 'weight')
+    n_etfs = W.shape[0]
+
+    etf, flow = _flows.get(date, (np.array([], dtype=np.int64), np.array([])))
+    valid = (etf >= 0) & (etf < n_etfs)  # ETFs without holdings are not in the dictionary.
+    f = np.bincount(etf[valid], np.nan_to_num(flow[valid]), minlength=n_etfs)
+
+    demand = W.T @ f
+    n_funds = (W != 0).T @ (f != 0).astype(float)  # number of ETFs with flow holding each security
+    security = np.flatnonzero(n_funds)
+
+    df = pd.DataFrame({
+        'date': pd.Timestamp(date),
+        'cusip': pd.Categorical.from_codes(security, categories=get_dictionary('security')),
+        'demand': demand[security],
+        'n_etfs': n_funds[security].astype('int32'),
+    })
+
+    permno_path = _ownership_path('permno', _weight_dates[date])
+    if os.path.exists(permno_path):
+        links = np.load(permno_path)
+        permno = pd.Series(links['permno'], index=links['security'])
+        df['permno'] = pd.array(permno.reindex(security).to_numpy(), dtype=compact_dtypes['permno'])
+    return df
+
+
+@instrumented('flow_demand')
+def compute_flow_demand(sdate=None, edate=None, lag=1, n_jobs=1):
+    """Compute flow-induced demand per security and date: the sum over ETFs of weight x fund flow.
+
+    Demand on date t is W' f, where W is the ETF x security weight matrix (see get_ownership_matrix()) of the holdings
+    snapshot `lag` snapshots before t, and f is the fund flow of each ETF on t, indexed by the 'etf' dictionary. The
+    snapshots are the dates actually in the holdings store, so a date whose holdings failed falls back to the previous
+    snapshot. The fund flows are read once per partition and passed to the workers. Dates are processed in parallel
+    and written to the 'flow_demand' dataset partition by partition.
+
+    Args:
+        sdate: Start date (inclusive).
+        edate: End date (inclusive).
+        lag: Number of holdings dates between the weights and the flow. With `lag` = 1, flows are allocated using the
+            previous day's holdings, which are known when the flows occur.
+        n_jobs: Number of worker processes.
+    """
+    # Build the matrices before forking so that workers do not build the same partition concurrently. The partition
+    # before `sdate` is included for the lagged weights.
+    partitions = [p for p in list_partitions('holdings') if not edate or p <= (int(edate[:4]), int(edate[5:7]))]
+    if sdate:
+        start = [i for i, p in enumerate(partitions) if p >= (int(sdate[:4]), int(sdate[5:7]))]
+        partitions = partitions[max(start[0] - 1, 0):] if start else []
+    holdings_dates = []
+    for year, month in partitions:
+        if _is_ownership_stale(pd.Timestamp(year, month, 1)):
+            build_ownership_matrices(year, month)
+        with open(_ownership_stamp_path(year, month), 'r') as f:
+            holdings_dates += json.load(f)['dates']
+    holdings_dates = np.array(sorted(holdings_dates))
+
+    # Weights of flow date t: the holdings date `lag` snapshots before t. If t has no holdings, e.g., its file failed,
+    # the snapshots before t are used as if t were present.
+    weight_dates = {}
+    for date in get_avaiable_dates(sdate, edate, 'fundflow'):
+        n_before = np.searchsorted(holdings_dates, date, side='right')  # holdings dates <= t
+        position = n_before - 1 if (n_before and holdings_dates[n_before - 1] == date) else n_before
+        i = min(position - lag, n_before - 1)
+        if i >= 0:
+            weight_dates[date] = str(holdings_dates[i])
+    dates = list(weight_dates)
+    flows = _load_flows(dates)
+
+    writer = PartitionWriter('flow_demand', ['date', 'cusip'], update=True)
+    failures = []
+    for date, df, error in map_dates(_compute_flow_demand, dates, n_jobs, _set_flow_inputs, (weight_dates, flows)):
+        if error:
+            failures.append((date, error))
+            continue
+
+        writer.add(date, df)
+    writer.flush()
+    report_failures('flow_demand', failures)
+
+
+def diff_holdings_frame(holdings):
+    """Diff consecutive holdings snapshots of each ETF.
+
+    A snapshot is the holdings of an ETF on a date. Rows are matched by security between each snapshot and the previous
+    snapshot of the same ETF in a single sorted pass over (ETF, security, snapshot), without per-ETF loops. Rows with
+    null cusips cannot be matched and are ignored. The first snapshot of each ETF has no events.
+
+    Args:
+        holdings: Compact holdings DataFrame with columns date, composite_ticker, cusip, shares_held, and market_value.
+
+    Returns:
+        DataFrame of events with columns date, prev_date, composite_ticker, cusip, action ('add', 'drop', or
+        'change'), prev_shares, shares_held, shares_change, price, and trade_value. Price is market_value / shares_held
+        of the current snapshot, or of the previous snapshot for drops, and trade_value = shares_change x price.
+    """
+    etf = holdings['composite_ticker'].cat.codes.to_numpy()
+    date = holdings['date'].to_numpy()
+    snapshots = pd.DataFrame({'etf': etf, 'date': date}).drop_duplicates().sort_values(['etf', 'date'])
+    snapshots = snapshots.reset_index(drop=True)
+    snap_etf = snapshots['etf'].to_numpy()
+    snap_date = snapshots['date'].to_numpy()
+    is_first = np.r_[True, snap_etf[1:] != snap_etf[:-1]]  # first snapshot of the ETF
+    is_last = np.r_[snap_etf[1:] != snap_etf[:-1], True]  # last snapshot of the ETF
+    snap = pd.MultiIndex.from_frame(snapshots).get_indexer(pd.MultiIndex.from_arrays([etf, date]))
+
+    security = holdings['cusip'].cat.codes.to_numpy()
+    valid = security >= 0
+    rows = pd.DataFrame({
+        'snap': snap[valid],
+        'security': security[valid],
+        'shares': holdings['shares_held'].to_numpy(dtype=float)[valid],
+        'value': holdings['market_value'].to_numpy(dtype=float)[valid],
+    }).groupby(['snap', 'security'], sort=False).sum(min_count=1).reset_index()  # duplicate securities are summed.
+
+    s = rows['snap'].to_numpy()
+    c = rows['security'].to_numpy()
+    e = snap_etf[s]
+    order = np.lexsort((s, c, e))
+    s, c, e = s[order], c[order], e[order]
+    shares = rows['shares'].to_numpy()[order]
+    price = rows['value'].to_numpy()[order] / np.where(shares == 0, np.nan, shares)
+
+    # Row i continues row i-1 if they are the same security of the same ETF in consecutive snapshots.
+    continued = (e[1:] == e[:-1]) & (c[1:] == c[:-1]) & (s[1:] == s[:-1] + 1)
+    change = np.flatnonzero(continued) + 1
+    add = np.flatnonzero(~np.r_[False, continued] & ~is_first[s])
+    drop = np.flatnonzero(~np.r_[continued, False] & ~is_last[s])
+
+    nan = np.full(len(s), np.nan)
+    prev_shares = np.r_[np.nan, shares[:-1]]
+    events = []
+    for action, idx, snap_, prev, curr, price_ in [
+        ('change', change, s[change], prev_shares[change], shares[change], price[change]),
+        ('add', add, s[add], nan[add], shares[add], price[add]),
+        ('drop', drop, s[drop] + 1, shares[drop], nan[drop], price[drop]),
+    ]:
+        events.append(pd.DataFrame({
+            'snap': snap_,
+            'security': c[idx],
+            'action': action,
+            'prev_shares': prev,
+            'shares_held': curr,
+            'shares_change': np.nan_to_num(curr) - np.nan_to_num(prev),
+            'price': price_,
+        }))
+    events = pd.concat(events, ignore_index=True)
+    events = events[(events['action'] != 'change') | (events['shares_change'] != 0)]
+
+    snap_ = events['snap'].to_numpy()
+    return pd.DataFrame({
+        'date': snap_date[snap_],
+        'prev_date': snap_date[snap_ - 1],
+        'composite_ticker': pd.Categorical.from_codes(snap_etf[snap_],
+                                                      categories=holdings['composite_ticker'].cat.categories),
+        'cusip': pd.Categorical.from_codes(events['security'].to_numpy(), categories=holdings['cusip'].cat.categories),
+        'action': pd.Categorical(events['action'], categories=['add', 'drop', 'change']),
+        'prev_shares': events['prev_shares'].to_numpy(),
+        'shares_held': events['shares_held'].to_numpy(),
+        'shares_change': events['shares_change'].to_numpy(),
+        'price': events['price'].to_numpy(),
+        'trade_value': events['shares_change'].to_numpy() * events['price'].to_numpy(),
+    })
+
+
+def _last_snapshots(holdings):
+    last_date = holdings.groupby('composite_ticker', observed=True)['date'].transform('max')
+    return holdings[holdings['date'] == last_date]
+
+
+@instrumented('holdings_diff')
+def diff_holdings(sdate=None, edate=None):
+    """Compute the day-over-day holdings changes of every ETF and write them to the 'holdings_diff' dataset.
+
+    Holdings partitions are streamed in date order. The last snapshot of each ETF is carried into the next partition,
+    so the first date of a partition is diffed against the previous partition. Memory is bounded by one partition.
+    See diff_holdings_frame() for the output.
+
+    Args:
+        sdate: Start date. The partitions from the one containing `sdate` are processed, and the last snapshots of
+            the partition before it are used as the previous snapshots.
+        edate: End date. The partitions up to the one containing `edate` are processed.
+    """
+    columns = ['date', 'composite_ticker', 'cusip', 'shares_held', 'market_value']
+    partitions = list_partitions('holdings')
+    start = (pd.Timestamp(sdate).year, pd.Timestamp(sdate).month) if sdate else partitions[0]
+    end = (pd.Timestamp(edate).year, pd.Timestamp(edate).month) if edate else partitions[-1]
+
+    carry = None
+    previous = [p for p in partitions if p < start]
+    if previous:
+        carry = _last_snapshots(read_partition('holdings', *previous[-1], columns))
+
+    for year, month in [p for p in partitions if start <= p <= end]:
+        holdings = read_partition('holdings', year, month, columns)
+        if carry is not None:
+            holdings = compact_frame(pd.concat([carry, holdings]), 'holdings')
+
+        events = diff_holdings_frame(holdings)
+        write_partition(sort_frame(events, ['composite_ticker', 'date', 'cusip']), 'holdings_diff', year, month)
+
+        carry = _last_snapshots(holdings)
+
+
+def _qa_partition(partition):
+    year, month = partition
+    holdings = read_partition('holdings', year, month)
+    etf = holdings['composite_ticker'].cat.codes.to_numpy()
+    security = holdings['cusip'].cat.codes.to_numpy()
+    weight = holdings['weight'].to_numpy(dtype=float, na_value=np.nan)
+    market_value = np.nan_to_num(holdings['market_value'].to_numpy(dtype=float, na_value=np.nan))
+
+    # Synthetic cusips are '{1000000 + n}X' (see assign_synthetic_cusips()). Code -1 (null) maps to the appended False.
+    is_synthetic = np.asarray(holdings['cusip'].cat.categories.str.fullmatch(r'1\d{6}X'), dtype=bool)
+    is_synthetic = np.append(is_synthetic, False)
+    linked = holdings['permno'].notna().to_numpy() if 'permno' in holdings else np.zeros(len(holdings), dtype=bool)
+
+    rows = pd.DataFrame({
+        'etf': etf,
+        'date': holdings['date'].to_numpy(),
+        'n_holdings': 1,
+        'weight_sum': np.nan_to_num(weight),
+        'negative_weights': weight < 0,
+        'null_cusips': security < 0,
+        'synthetic_cusips': is_synthetic[security],
+        'market_value': market_value,
+        'linked_market_value': np.where(linked, market_value, 0),
+    })
+    qa = rows.groupby(['etf', 'date'], sort=False).sum().reset_index()
+    etfs = holdings['composite_ticker'].cat.categories
+    qa['composite_ticker'] = pd.Categorical.from_codes(qa.pop('etf'), categories=etfs)
+
+    for col in ['n_holdings', 'negative_weights', 'null_cusips', 'synthetic_cusips']:
+        qa[col] = qa[col].astype('int32')
+    qa['linked_ratio'] = qa['linked_market_value'] / qa['market_value'].where(qa['market_value'] != 0)
+    qa['null_cusip_share'] = (qa['null_cusips'] + qa['synthetic_cusips']) / qa['n_holdings']
+
+    if (year, month) in list_partitions('fundflow'):
+        flow = read_partition('fundflow', year, month, ['date', 'ticker', 'shrout', 'nav'])
+        flow['aum'] = flow['nav'] * flow['shrout']
+        flow = flow.rename(columns={'ticker': 'composite_ticker'})[['composite_ticker', 'date', 'aum']]
+        flow = flow.drop_duplicates(['composite_ticker', 'date'], keep='last')
+        qa = compact_frame(qa, 'holdings_qa').merge(compact_frame(flow, 'holdings_qa'), on=['composite_ticker', 'date'],
+                                                    how='left')
+    else:
+        qa['aum'] = np.nan
+    qa['aum_ratio'] = qa['aum'] / qa['market_value'].where(qa['market_value'] != 0)
+
+    return qa
+
+
+@instrumented('holdings_qa')
+def qa_holdings(sdate=None, edate=None, n_jobs=1, tolerance=0.01):
+    """Compute quality metrics of the holdings per (ETF, date) and write them to the 'holdings_qa' dataset.
+
+    Each holdings partition is reduced in a single groupby pass, and the partitions are processed in parallel, so only
+    `n_jobs` partitions are in memory at a time. The report has, for each ETF and date:
+
+        n_holdings: Number of holdings.
+        weight_sum: Sum of weights. Should be about 1.
+        negative_weights: Number of negative weights, e.g., short positions or cash.
+        null_cusips, synthetic_cusips: Number of holdings whose cusip is null or synthetic (see
+            assign_synthetic_cusips()), and null_cusip_share: their share of n_holdings.
+        market_value, linked_market_value: Sum of market values, in total and of the holdings linked to permno.
+        linked_ratio: linked_market_value / market_value.
+        aum, aum_ratio: NAV x shares outstanding from the fund flows, and aum / market_value. Should be about 1.
+
+    Args:
+        sdate: Start date. The partitions from the one containing `sdate` are processed.
+        edate: End date. The partitions up to the one containing `edate` are processed.
+        n_jobs: Number of worker processes.
+        tolerance: Tolerance of weight_sum and aum_ratio from 1 used in the summary log.
+    """
+    partitions = list_partitions('holdings')
+    if sdate:
+        partitions = [p for p in partitions if p >= (pd.Timestamp(sdate).year, pd.Timestamp(sdate).month)]
+    if edate:
+        partitions = [p for p in partitions if p <= (pd.Timestamp(edate).year, pd.Timestamp(edate).month)]
+
+    n_rows = n_weight = n_aum = 0
+    failures = []
+    for partition, qa, error in map_dates(_qa_partition, partitions, n_jobs):
+        if error:
+            failures.append((partition, error))
+            continue
+
+        write_partition(sort_frame(qa, ['composite_ticker', 'date']), 'holdings_qa', *partition)
+        n_rows += len(qa)
+        n_weight += int(((qa['weight_sum'] - 1).abs() > tolerance).sum())
+        n_aum += int(((qa['aum_ratio'] - 1).abs() > tolerance).sum())
+    report_failures('holdings_qa', failures)
+    if failures and (len(failures) == len(partitions)):
+        raise RuntimeError(f'holdings_qa: all {len(partitions)} partitions failed.')
+
+    log(f'holdings_qa: {n_rows} ETF-dates, weight sum off by > {tolerance}: {n_weight}, '
+        f'aum / market value off by > {tolerance}: {n_aum}.')
+
+
+HOLDINGS_INDEX_PATH = DATA_DIR + 'holdings_index.pickle'
+# Index key: (dataset, holdings column, dictionary). Keys without a dictionary are integers, e.g., permno. ETFs are
+# looked up in the holdings store, sorted by ETF, and securities in a copy sorted by security, 'holdings_by_security',
+# so that the rows of a key are contiguous in both.
+holdings_index_keys = {
+    'etf': ('holdings', 'composite_ticker', 'etf'),
+    'security': ('holdings_by_security', 'cusip', 'security'),
+    'permno': ('holdings_by_security', 'permno', None),
+}
+
+
+def _key_runs(codes):
+    """Row ranges of a key column: (keys, starts, ends) of the runs of equal keys, sorted by key. Negative codes (null)
+    are dropped.
+    """
+    if not len(codes):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    keys = codes[starts]
+    valid = keys >= 0
+    order = np.argsort(keys[valid], kind='stable')
+    return keys[valid][order], starts[valid][order], ends[valid][order]
+
+
+def _index_file(dataset, year, month, keys):
+    path = get_partition_dir(dataset, year, month) + 'part-0.parquet'
+    file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+    meta = file.metadata
+    index = {
+        'mtime': os.path.getmtime(path),
+        'offsets': np.cumsum([0] + [meta.row_group(i).num_rows for i in range(meta.num_row_groups)]),
+    }
+    columns = [holdings_index_keys[key][1] for key in keys if holdings_index_keys[key][1] in file.schema_arrow.names]
+    df = compact_frame(file.read(columns=columns).to_pandas(), dataset)
+    for key in keys:
+        _, col, dictionary = holdings_index_keys[key]
+        if col not in df:  # e.g., permno before linking
+            continue
+        if dictionary:
+            codes = df[col].cat.codes.to_numpy().astype(np.int64)
+        else:
+            codes = df[col].to_numpy(dtype=float, na_value=np.nan)
+            codes = np.where(np.isnan(codes), -1, codes).astype(np.int64)
+        index[key] = _key_runs(codes)
+    return index
+
+
+def _index_partition(year, month):
+    """Index a holdings partition: for each key in `holdings_index_keys`, the row ranges of the key in its dataset.
+
+    The 'holdings_by_security' copy of the partition, sorted by permno, cusip, and date, is (re)written first.
+    """
+    holdings = read_partition('holdings', year, month)
+    sort_by = [col for col in ['permno', 'cusip', 'date'] if col in holdings]
+    write_partition(sort_frame(holdings, sort_by), 'holdings_by_security', year, month)
+    del holdings
+
+    path = get_partition_dir('holdings', year, month) + 'part-0.parquet'
+    return {
+        'mtime': os.path.getmtime(path),
+        'holdings': _index_file('holdings', year, month, ['etf']),
+        'holdings_by_security': _index_file('holdings_by_security', year, month, ['security', 'permno']),
+    }
+
+
+@instrumented('index')
+def update_holdings_index():
+    """Update the secondary index of the holdings store from ETF, security, and permno to row ranges.
+
+    The index is kept in HOLDINGS_INDEX_PATH as {(year, month): partition index}. Partitions added or modified since
+    they were indexed, e.g., by link_etfg_permno(), are reindexed together with their 'holdings_by_security' copies,
+    and the entries and copies of removed partitions are deleted. Run after the holdings or link stage.
+    """
+    index = pd.read_pickle(HOLDINGS_INDEX_PATH) if os.path.exists(HOLDINGS_INDEX_PATH) else {}
+    partitions = list_partitions('holdings')
+
+    for partition in [p for p in index if p not in partitions]:
+        del index[partition]
+    prune_partitions('holdings_by_security', [f'{year}-{month:02d}-01' for year, month in partitions])
+    for year, month in partitions:
+        mtime = os.path.getmtime(get_partition_dir('holdings', year, month) + 'part-0.parquet')
+        entry = index.get((year, month))
+        if (entry is None) or (entry['mtime'] != mtime) or ('mtime' not in entry.get('holdings', {})):  # or old format
+            index[(year, month)] = _index_partition(year, month)
+
+    os.makedirs(os.path.dirname(HOLDINGS_INDEX_PATH), exist_ok=True)
+    pd.to_pickle(index, HOLDINGS_INDEX_PATH + '.tmp')
+    os.replace(HOLDINGS_INDEX_PATH + '.tmp', HOLDINGS_INDEX_PATH)
+    return index
+
+
+_holdings_index = (None, None)  # (mtime, index) of HOLDINGS_INDEX_PATH loaded in this process.
+
+
+def load_holdings_index():
+    """Load the holdings index saved by update_holdings_index(). The index is cached in the process and reloaded only
+    when the file changes.
+    """
+    global _holdings_index
+    if not os.path.exists(HOLDINGS_INDEX_PATH):
+        raise FileNotFoundError(f'{HOLDINGS_INDEX_PATH} not found. Run update_holdings_index().')
+
+    mtime = os.path.getmtime(HOLDINGS_INDEX_PATH)
+    if _holdings_index[0] != mtime:
+        _holdings_index = (mtime, pd.read_pickle(HOLDINGS_INDEX_PATH))
+    return _holdings_index[1]
+
+
+def _read_row_ranges(path, offsets, starts, ends, columns=None):
+    """Read the rows [starts[i], ends[i]) of a parquet file. Only the row groups overlapping the ranges are read, from
+    the memory-mapped file.
+    """
+    first = np.searchsorted(offsets, starts, side='right') - 1
+    last = np.searchsorted(offsets, ends - 1, side='right') - 1
+    groups = np.unique(np.concatenate([np.arange(f, l + 1) for f, l in zip(first, last)]))
+
+    file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+    table = file.read_row_groups(groups.tolist(), columns=columns)
+
+    # position of each row group in the table
+    sizes = offsets[groups + 1] - offsets[groups]
+    table_offsets = np.full(len(offsets), -1)
+    table_offsets[groups] = np.cumsum(sizes) - sizes
+
+    rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+    row_groups = np.searchsorted(offsets, rows, side='right') - 1
+    return table.take(table_offsets[row_groups] + rows - offsets[row_groups])
+
+
+def _empty_holdings(columns=None):
+    df = pd.DataFrame({col: pd.Series(dtype=object) for col in columns or holdings_columns})
+    if 'date' in df:
+        df['date'] = df['date'].astype('datetime64[ns]')
+    return compact_frame(df, 'holdings')
+
+
+def _query_holdings(key, values, start=None, end=None, columns=None):
+    dataset, col, dictionary = holdings_index_keys[key]
+    values = pd.Index(np.atleast_1d(values))
+    codes = get_dictionary(dictionary).get_indexer(values) if dictionary else values.to_numpy(dtype=np.int64)
+    codes = np.unique(codes[codes >= 0])
+
+    start = pd.Timestamp(start) if start else None
+    end = pd.Timestamp(end) if end else None
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['date']))
+    index = load_holdings_index()
+    frames = []
+    for (year, month), entry in sorted(index.items()):
+        if (start and (year, month) < (start.year, start.month)) or (end and (year, month) > (end.year, end.month)):
+            continue
+        if key not in entry[dataset]:  # e.g., permno before linking
+            continue
+
+        keys, starts, ends = entry[dataset][key]
+        lo = np.searchsorted(keys, codes, side='left')
+        hi = np.searchsorted(keys, codes, side='right')
+        runs = np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)] + [[]]).astype(np.int64)
+        if not len(runs):
+            continue
+
+        path = get_partition_dir(dataset, year, month) + 'part-0.parquet'
+        if os.path.getmtime(path) != entry[dataset]['mtime']:
+            raise RuntimeError(f'{dataset} {year}-{month:02d} was modified after indexing. Run update_holdings_index()')
+        table = _read_row_ranges(path, entry[dataset]['offsets'], starts[runs], ends[runs], read_columns)
+        df = compact_frame(table.to_pandas(), 'holdings')
+        mask = np.ones(len(df), dtype=bool)
+        if start:
+            mask &= df['date'] >= start
+        if end:
+            mask &= df['date'] <= end
+        frames.append(df[mask])
+
+    if not frames:
+        return _empty_holdings(columns)
+
+    df = compact_frame(pd.concat(frames, ignore_index=True), 'holdings')
+    return df[list(columns)] if columns is not None else df
+
+
+def get_holdings(etfs, start=None, end=None, columns=None):
+    """Get the holdings of ETFs between `start` and `end` (inclusive).
+
+    Only the rows of the ETFs are taken, from the row groups containing them. The rows are located by the holdings index
+    (see update_holdings_index()), and files are memory-mapped.
+
+    Args:
+        etfs: ETF ticker or list of tickers.
+        start: Start date.
+        end: End date.
+        columns: List of columns. If None, all columns.
+
+    Returns:
+        Compact holdings DataFrame.
+    """
+    return _query_holdings('etf', etfs, start, end, columns)
+
+
+def get_holders(permno, start=None, end=None, columns=None, by='permno'):
+    """Get the ETF holdings of stocks between `start` and `end` (inclusive). See get_holdings().
+
+    Args:
+        permno: PERMNO or list of PERMNOs, or cusip(s) if `by` = 'security'.
+        by: 'permno' or 'security'. Holdings must have been linked by link_etfg_permno() to query by permno.
+    """
+    return _query_holdings(by, permno, start, end, columns)
+
 
 def get_db_info():
     profile = pd.read_pickle('./data/profile.pickle')
@@ -520,6 +2784,7 @@ def get_db_info():
     log(f'num equity etfs = {profile.shape[0]}')
 
 
+@instrumented('equity')
 def generate_equity_etf_data():
     profile = pd.read_pickle(DATA_DIR + 'profile.pickle')
     profile = profile[profile.asset_class == 'Equity']
@@ -527,16 +2792,12 @@ def generate_equity_etf_data():
     profile = profile.reset_index()
     profile.to_pickle(EQUITY_DATA_DIR + 'profile.pickle')
 
-    flow = pd.read_pickle(DATA_DIR + 'fundflow.pickle')
-    flow = flow[flow.ticker.isin(profile.ticker)]
-    flow.to_pickle(EQUITY_DATA_DIR + 'fundflow.pickle')
+    flow = read_dataset('fundflow', filters={'ticker': profile.ticker})
+    write_dataset(flow, 'fundflow', data_dir=EQUITY_DATA_DIR)
 
-    years = [2017, 2018, 2019, 2020, 2021]
-    for year in years:
-        file = f'holdings_{year}.pickle'
-        holdings = pd.read_pickle(DATA_DIR + file)
-        holdings = holdings[holdings.composite_ticker.isin(profile.ticker)]
-        holdings.to_pickle(EQUITY_DATA_DIR + file)
+    for year, month in list_partitions('holdings'):
+        holdings = read_partition('holdings', year, month, filters={'composite_ticker': profile.ticker})
+        write_partition(holdings, 'holdings', year, month, data_dir=EQUITY_DATA_DIR)
 
 if __name__ == '__main__':
     # df = process_profile_files()
@@ -547,13 +2808,13 @@ if __name__ == '__main__':
     years = [2017]#, 2018, 2019, 2020, 2021]
     for year in years:
         log(f'year: {year}')
-        file = f'holdings_{year}.pickle'
-        holdings = pd.read_pickle(EQUITY_DATA_DIR + file)
+        holdings = read_dataset('holdings', ['composite_ticker', 'market_value', 'permno'], f'{year}-01-01',
+                                f'{year}-12-31', data_dir=EQUITY_DATA_DIR)
         log(f'num. etfs: {len(holdings.composite_ticker.unique())}')
 
         holdings['market_value2'] = holdings['market_value']
         holdings.loc[holdings.permno.isna(), 'market_value2'] = 0
-        market_value = holdings.groupby('composite_ticker')[['market_value', 'market_value2']].sum()
+        market_value = holdings.groupby('composite_ticker', observed=True)[['market_value', 'market_value2']].sum()
 
     # process_constituent_files2('2017-01-01', '2017-01-10')
     # profile = read_profile('2021-12-31')
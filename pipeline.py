@@ -0,0 +1,310 @@
+"""Dependency-aware runner of the file_handler2 stages.
+
+Usage:
+    python pipeline.py                      # run the stale stages
+    python pipeline.py equity --dry-run     # show the stages equity needs to re-run
+    python pipeline.py holdings --sdate 2020-01-01 --edate 2020-12-31 --n-jobs 8 --incremental
+
+The stages form a DAG. Each stage is fingerprinted by the size and mtime of its input files, its parameters, the CRSP
+snapshots it reads, and the fingerprints of the stages it depends on. A stage re-runs only if its fingerprint differs
+from that of its last successful run or its outputs are missing. A run in which any date fails is not successful.
+Stages whose dependencies are done run concurrently, each in its own process, except that stages updating the shared
+dictionaries never overlap.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+
+import file_handler2 as fh
+from pyanomaly.globals import *
+
+PIPELINE_STATE_PATH = fh.DATA_DIR + 'pipeline_state.json'
+
+# stage: deps (stages whose outputs it reads), inputs (ETFG datasets it reads), crsp (CRSP tables it reads),
+# params (arguments that change its output), outputs (paths it writes), and locks (resources it updates).
+pipeline_stages = {
+    'profile': {
+        'deps': [],
+        'inputs': ['industry'],
+        'crsp': [],
+        'params': ['sdate', 'edate'],
+        'outputs': [fh.DATA_DIR + 'profile.pickle'],
+        'locks': [],
+    },
+    'fundflow': {
+        'deps': [],
+        'inputs': ['fundflow'],
+        'crsp': [],
+        'params': ['sdate', 'edate'],
+        'outputs': [fh.DATA_DIR + 'fundflow/'],
+        'locks': ['dictionaries'],
+    },
+    'securities': {
+        'deps': [],
+        'inputs': ['constituents'],
+        'crsp': [],
+        'params': ['sdate', 'edate'],
+        'outputs': [fh.DATA_DIR + 'securities.pickle', fh.SECURITY_INDEX_PATH],
+        'locks': [],
+    },
+    'holdings': {
+        'deps': ['securities'],
+        'inputs': ['constituents'],
+        'crsp': [],
+        'params': ['sdate', 'edate'],
+        'outputs': [fh.DATA_DIR + 'holdings/'],
+        'locks': ['dictionaries'],
+    },
+    'link': {
+        'deps': ['securities', 'holdings'],
+        'inputs': [],
+        'crsp': ['stocknames'],
+        'params': [],
+        'outputs': [],  # updates securities and holdings in place
+        'locks': ['dictionaries'],
+    },
+    'qa': {
+        'deps': ['fundflow', 'holdings', 'link'],
+        'inputs': [],
+        'crsp': [],
+        'params': [],
+        'outputs': [fh.DATA_DIR + 'holdings_qa/'],
+        'locks': ['dictionaries'],
+    },
+    'index': {
+        'deps': ['holdings', 'link'],
+        'inputs': [],
+        'crsp': [],
+        'params': [],
+        'outputs': [fh.HOLDINGS_INDEX_PATH, fh.DATA_DIR + 'holdings_by_security/'],
+        'locks': ['dictionaries'],
+    },
+    'equity': {
+        'deps': ['profile', 'fundflow', 'holdings', 'link'],
+        'inputs': [],
+        'crsp': [],
+        'params': [],
+        'outputs': [fh.EQUITY_DATA_DIR + 'profile.pickle', fh.EQUITY_DATA_DIR + 'holdings/'],
+        'locks': ['dictionaries'],  # write_partition() may append to the dictionaries.
+    },
+}
+
+
+def run_stage(stage, sdate=None, edate=None, n_jobs=1, incremental=False, max_memory_mb=1024):
+    """Run a stage in this process.
+
+    Returns:
+        Dict of {stage: number of failed dates or partitions}, see file_handler2.report_failures(). Empty if the stage
+        fully succeeded.
+    """
+    fh.failed_items.clear()
+    if stage == 'profile':
+        fh.process_profile_files(sdate, edate, n_jobs=n_jobs, incremental=incremental)
+    elif stage == 'fundflow':
+        fh.process_fundflow_files(sdate, edate, n_jobs=n_jobs, incremental=incremental)
+    elif stage == 'securities':
+        fh.process_constituent_files1(sdate, edate, incremental=incremental)
+    elif stage == 'holdings':
+        fh.process_constituent_files2(sdate, edate, n_jobs=n_jobs, incremental=incremental)
+    elif stage == 'link':
+        fh.link_etfg_permno(max_memory_mb)
+    elif stage == 'index':
+        fh.update_holdings_index()
+    elif stage == 'qa':
+        fh.qa_holdings(n_jobs=n_jobs)
+    elif stage == 'equity':
+        os.makedirs(fh.EQUITY_DATA_DIR, exist_ok=True)
+        fh.generate_equity_etf_data()
+    else:
+        raise ValueError(f'Unknown stage: {stage}')
+    return dict(fh.failed_items)
+
+
+def get_upstream(stages):
+    """`stages` and the stages they depend on, in topological order.
+    """
+    order = []
+
+    def visit(stage):
+        if stage in order:
+            return
+        for dep in pipeline_stages[stage]['deps']:
+            visit(dep)
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return order
+
+
+def get_input_signature(dataset, sdate=None, edate=None):
+    """sha1 hash of the date, size, and mtime of the files of a dataset.
+
+    The files are listed by the file catalog, and each file is stat-ed so that files rewritten in place, which the
+    catalog does not rescan, change the signature.
+    """
+    sha1 = hashlib.sha1()
+    for date in fh.get_avaiable_dates(sdate, edate, dataset):
+        try:
+            stat = os.stat(fh.get_file_path(dataset, date))
+            sha1.update(f'{date}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        except OSError:
+            sha1.update(f'{date}:missing;'.encode())
+    return sha1.hexdigest()
+
+
+def get_fingerprints(params):
+    """Fingerprint of each stage: the sha1 hash of its inputs, parameters, CRSP snapshots, and dependencies.
+    """
+    catalogs = {}
+    fingerprints = {}
+    for stage in get_upstream(pipeline_stages):
+        spec = pipeline_stages[stage]
+        for dataset in spec['inputs']:
+            if dataset not in catalogs:
+                catalogs[dataset] = get_input_signature(dataset, params['sdate'], params['edate'])
+
+        key = {
+            'stage': stage,
+            'inputs': {dataset: catalogs[dataset] for dataset in spec['inputs']},
+            'params': {name: params[name] for name in spec['params']},
+            'crsp': {name: fh.get_crsp_table_info(name) for name in spec['crsp']},
+            'deps': {dep: fingerprints[dep] for dep in spec['deps']},
+        }
+        fingerprints[stage] = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    return fingerprints
+
+
+def load_state():
+    if not os.path.exists(PIPELINE_STATE_PATH):
+        return {}
+
+    with open(PIPELINE_STATE_PATH, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(PIPELINE_STATE_PATH), exist_ok=True)
+    with open(PIPELINE_STATE_PATH + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(PIPELINE_STATE_PATH + '.tmp', PIPELINE_STATE_PATH)
+
+
+def is_stale(stage, fingerprints, state):
+    record = state.get(stage)
+    if (record is None) or (record['fingerprint'] != fingerprints[stage]):
+        return True
+    return not all(os.path.exists(path) for path in pipeline_stages[stage]['outputs'])
+
+
+def _start_stage(stage, args):
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--n-jobs', str(args.n_jobs),
+               '--max-memory-mb', str(args.max_memory_mb)]
+    if args.sdate:
+        command += ['--sdate', args.sdate]
+    if args.edate:
+        command += ['--edate', args.edate]
+    if args.incremental:
+        command += ['--incremental']
+    return subprocess.Popen(command)
+
+
+def run_pipeline(args):
+    """Run the stale stages of `args.stages` and their dependencies.
+
+    A stage starts when all its dependencies have succeeded, at most `args.max_parallel` stages run at a time, and
+    stages sharing a lock never run together. If a stage fails, the stages depending on it are skipped.
+    """
+    params = {'sdate': args.sdate, 'edate': args.edate}
+    fingerprints = get_fingerprints(params)
+    state = load_state()
+
+    stale = []
+    for stage in get_upstream(args.stages or list(pipeline_stages)):  # dependencies first
+        deps_stale = any(dep in stale for dep in pipeline_stages[stage]['deps'])
+        if args.force or deps_stale or is_stale(stage, fingerprints, state):
+            stale.append(stage)
+    log(f'stale stages: {stale}')
+    if args.dry_run or not stale:
+        return True
+
+    pending = list(stale)
+    running = {}  # stage: (process, start time)
+    failed = set()
+    while pending or running:
+        for stage, (process, start) in list(running.items()):
+            if process.poll() is None:
+                continue
+
+            del running[stage]
+            if process.returncode == 0:
+                state[stage] = {
+                    'fingerprint': fingerprints[stage],
+                    'params': params,
+                    'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'seconds': time.time() - start,
+                }
+                save_state(state)
+                log(f'{stage}: done in {time.time() - start:.1f}s.')
+            else:
+                failed.add(stage)
+                log(f'{stage}: failed with exit code {process.returncode}.')
+
+        for stage in list(pending):
+            deps = pipeline_stages[stage]['deps']
+            if any(dep in failed for dep in deps):
+                pending.remove(stage)
+                failed.add(stage)
+                log(f'{stage}: skipped as its dependencies failed.')
+                continue
+
+            if any((dep in pending) or (dep in running) for dep in deps) or (len(running) >= args.max_parallel):
+                continue
+            locks = set(pipeline_stages[stage]['locks'])
+            if any(locks & set(pipeline_stages[other]['locks']) for other in running):
+                continue
+
+            log(f'{stage}: started.')
+            running[stage] = (_start_stage(stage, args), time.time())
+            pending.remove(stage)
+
+        time.sleep(1)
+
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('stages', nargs='*', help=f'stages to bring up to date: {list(pipeline_stages)}. Default to '
+                                                  'all stages.')
+    parser.add_argument('--sdate', help='start date (inclusive).')
+    parser.add_argument('--edate', help='end date (inclusive).')
+    parser.add_argument('--n-jobs', type=int, default=1, help='worker processes of each stage.')
+    parser.add_argument('--max-parallel', type=int, default=2, help='maximum number of stages running at a time.')
+    parser.add_argument('--max-memory-mb', type=int, default=1024, help='memory budget of link_etfg_permno().')
+    parser.add_argument('--incremental', action='store_true', help='process only new or changed files.')
+    parser.add_argument('--force', action='store_true', help='re-run the stages even if they are up to date.')
+    parser.add_argument('--dry-run', action='store_true', help='only show the stale stages.')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)  # run a single stage in this process.
+    args = parser.parse_args()
+    unknown = [stage for stage in args.stages + [args.stage or 'profile'] if stage not in pipeline_stages]
+    if unknown:
+        parser.error(f'unknown stages: {unknown}')
+
+    if args.stage:
+        failures = run_stage(args.stage, args.sdate, args.edate, args.n_jobs, args.incremental, args.max_memory_mb)
+        if failures:  # the stage is not recorded as done, so it is retried in the next run.
+            log(f'{args.stage}: failures: {failures}')
+            sys.exit(2)
+        return
+
+    sys.exit(0 if run_pipeline(args) else 1)
+
+
+if __name__ == '__main__':
+    main()